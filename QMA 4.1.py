@@ -1,8 +1,220 @@
 import pandas as pd
+import numpy as np
 import time
 from datetime import datetime
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
+from openpyxl.utils import get_column_letter
 import os
+import sys
+import re
+import glob
+import argparse
+import sqlite3
+from contextlib import closing, contextmanager
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import zipfile
+import posixpath
+import hashlib
+import json
+import shutil
+import signal
+import warnings
+import tempfile
+import pickle
+import heapq
+import io
+import cProfile
+import pstats
+import tracemalloc
+from collections import namedtuple, Counter
+from functools import lru_cache
+from itertools import chain
+from html import unescape
+from xml.sax.saxutils import escape
+from xml.etree.ElementTree import fromstring, iterparse
+
+METRIC_SUFFIXES = ('_demand', '_shows', '_position', '_clicks', '_ctr')
+
+# Колонки метрик, которые нужны каждому режиму анализа
+MODE_SUFFIXES = {
+    1: ('_demand', '_shows', '_position', '_clicks'),
+    2: ('_shows', '_position', '_clicks', '_ctr'),
+}
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+CACHE_DIR = '.qma_cache'
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+# Увеличивается при любом изменении формата данных, которые возвращает загрузчик
+CACHE_VERSION = 2
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# Стеммер Snowball для русского и английского; без него используется встроенный
+try:
+    import snowballstemmer
+except ImportError:
+    snowballstemmer = None
+
+# Пиковый RSS процесса; модуля resource нет в Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+EXCEL_MAX_ROWS = 1048576
+
+TREND_COLUMNS = ['Тренд позиции', 'Тренд показов', 'Тренд кликов', 'Δ позиции', 'Δ показов', 'Δ кликов']
+
+# Колонка, по которой отбираются первые N строк (--top) и сортируется отчет по запросам
+SORT_COLUMNS = {1: 'Сум. частотность за 14 дн', 2: 'Сум. показов за 14 дн'}
+
+# Реестр метрик: колонки-источники по суффиксу, свертка по дням ('sum',
+# 'mean', 'median' или 'ratio' — 100 * сумма первого источника / сумма
+# второго), маскирование нулей (нет данных за день) и число знаков после
+# округления. compile_metrics сводит нужные метрики к общим сверткам, так
+# что, например, сумма показов считается один раз для всех метрик
+Metric = namedtuple('Metric', ['inputs', 'reduction', 'mask_zeros', 'decimals'])
+METRICS = {
+    'Сум. частотность за 14 дн': Metric(('_demand',), 'sum', False, None),
+    'Сум. показов за 14 дн': Metric(('_shows',), 'sum', False, None),
+    'Ср. позиция': Metric(('_position',), 'mean', True, 1),
+    'Медианная позиция': Metric(('_position',), 'median', True, 1),
+    'Охват': Metric(('_shows', '_demand'), 'ratio', False, 1),
+    'Ср. дн. частотность': Metric(('_demand',), 'mean', False, 0),
+    'Ср. дн. показов': Metric(('_shows',), 'mean', False, 0),
+    'Ср. число кликов': Metric(('_clicks',), 'mean', False, 0),
+    'Сум. кликов за 14 дн.': Metric(('_clicks',), 'sum', False, None),
+    'Ср. CTR': Metric(('_ctr',), 'mean', False, 1),
+}
+REPORT_METRICS = {
+    1: ('Сум. частотность за 14 дн', 'Сум. показов за 14 дн', 'Ср. позиция', 'Медианная позиция', 'Охват',
+        'Ср. дн. частотность', 'Ср. число кликов', 'Сум. кликов за 14 дн.'),
+    2: ('Сум. показов за 14 дн', 'Ср. позиция', 'Ср. дн. показов', 'Ср. число кликов', 'Сум. кликов за 14 дн.',
+        'Ср. CTR'),
+}
+
+# Метрики ежедневных колонок «ГГГГ-ММ-ДД_метрика», они же метрики истории
+DAILY_METRICS = tuple(suffix[1:] for suffix in METRIC_SUFFIXES)
+DAILY_COLUMN_RE = re.compile(rf"^(\d{{4}}-\d{{2}}-\d{{2}})_({'|'.join(DAILY_METRICS)})$")
+
+# Историческое хранилище: ключ (домен, запрос, URL) хранится один раз,
+# значения — по одной строке на (ключ, дату, метрику)
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS history_keys (
+    id INTEGER PRIMARY KEY,
+    domain TEXT NOT NULL,
+    query TEXT NOT NULL,
+    url TEXT NOT NULL,
+    UNIQUE (domain, query, url)
+);
+CREATE TABLE IF NOT EXISTS history (
+    key_id INTEGER NOT NULL REFERENCES history_keys (id),
+    date TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (key_id, date, metric)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS history_date ON history (date, metric);
+"""
+
+# Имена наборов данных для форматов без листов: файлы и таблицы SQLite
+DATASET_NAMES = {
+    'Семантическое ядро': 'semantics',
+    'Страницы': 'pages',
+    'Статистика слов': 'words',
+    'Биграммы': 'bigrams',
+    'Триграммы': 'trigrams',
+    'Кластеры': 'clusters',
+    'Дубли': 'duplicates',
+    'Каннибализация': 'cannibalization',
+    'Сводка по страницам': 'page_summary',
+    'Сравнение': 'compare',
+    'Новые запросы': 'new',
+    'Потерянные запросы': 'lost',
+    'Рост': 'winners',
+    'Падение': 'losers',
+    'История': 'history',
+}
+
+# Сравнение двух выгрузок (--compare): ключ строки, сравниваемые метрики и
+# число запросов на листах «Рост» и «Падение»
+COMPARE_KEYS = {1: ['Query'], 2: ['Url', 'Query']}
+COMPARE_METRICS = {
+    1: ['Ср. позиция', 'Сум. частотность за 14 дн', 'Сум. показов за 14 дн', 'Сум. кликов за 14 дн.', 'Охват'],
+    2: ['Ср. позиция', 'Сум. показов за 14 дн', 'Сум. кликов за 14 дн.'],
+}
+COMPARE_TOP = 100
+
+# Слежение за папкой (--watch): интервал опроса, сколько опросов подряд
+# размер и время изменения файла не должны меняться, прежде чем файл будет
+# взят в работу, и папки для обработанных и неудачных файлов внутри входящей
+WATCH_POLL_SECONDS = 2.0
+WATCH_STABLE_POLLS = 2
+# Файл, который за столько опросов без изменений так и не стал целым xlsx,
+# все же отдается в обработку, чтобы он ушел в failed, а не лежал вечно
+WATCH_BROKEN_POLLS = 30
+WATCH_DONE_DIR = 'done'
+WATCH_FAILED_DIR = 'failed'
+
+# Листы со статистикой словосочетаний и минимальное число запросов, в
+# которых должно встретиться словосочетание, чтобы попасть на лист
+NGRAM_SHEETS = {2: 'Биграммы', 3: 'Триграммы'}
+NGRAM_MIN_SUPPORT = 2
+# При обработке кусками словосочетания считаются приближенно (lossy counting):
+# на каждые NGRAM_BUCKET_ROWS запросов число запросов словосочетания может
+# оказаться заниженным не больше чем на один
+NGRAM_BUCKET_ROWS = 200000
+
+# Кластеризация запросов: MinHash из CLUSTER_HASHES функций, разбитый на
+# CLUSTER_BANDS полос для LSH, и порог оценки сходства Жаккара
+CLUSTER_HASHES = 32
+CLUSTER_BANDS = 16
+CLUSTER_THRESHOLD = 0.5
+
+# Поиск дублей: опечатки ищутся только в словах из букв не короче
+# DEDUP_MIN_WORD символов и на расстоянии не больше одной правки
+DEDUP_MIN_WORD = 5
+
+# Словари для колонок «Бренд» и «Интент». Интент запроса — первый по порядку
+# INTENT_LABELS словарь, слово или фраза из которого встретились в запросе.
+# Словари можно заменить файлом DICTIONARIES_FILE, бренды — флагом --brands
+DICTIONARIES_FILE = 'qma_dictionaries.json'
+DEFAULT_DICTIONARIES = {
+    'brand': [],
+    'informational': ['где', 'зачем', 'как', 'какой', 'какая', 'какие', 'какое', 'каков', 'когда', 'который',
+                      'которая', 'которое', 'кто', 'куда', 'откуда', 'почему', 'сколько', 'чей', 'что',
+                      'отзывы', 'своими руками', 'инструкция'],
+    'commercial': ['цена', 'цены', 'цене', 'купить', 'стоимость', 'заказать', 'недорого', 'дешево', 'доставка',
+                   'магазин', 'интернет магазин', 'прайс', 'скидка', 'акция', 'распродажа', 'оптом', 'аренда'],
+    'geo': ['москва', 'москве', 'москвы', 'спб', 'питер', 'санкт-петербург', 'рядом', 'адрес', 'на карте'],
+}
+INTENT_LABELS = {'informational': 'Информационный', 'commercial': 'Коммерческий', 'geo': 'Геозависимый'}
+INTENT_UNKNOWN = 'Неизвестно'
+
+QueryMatcher = namedtuple('QueryMatcher', ['words', 'stems', 'prefixes', 'phrases', 'bits'])
+PhraseTrie = namedtuple('PhraseTrie', ['parts', 'edges', 'children', 'bits', 'depth'])
+
+TokenStream = namedtuple('TokenStream', ['vocabulary', 'codes', 'rows', 'lengths', 'index'])
+
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
 
 def get_excel_files():
     return [f for f in os.listdir('.') if f.endswith('.xlsx')]
@@ -28,20 +240,22 @@ def select_file():
         except ValueError:
             print("Введите число.")
 
-def load_urls_from_file():
+def load_urls_from_file(file_path='urls.txt'):
     try:
-        if os.path.exists('urls.txt'):
-            with open('urls.txt', 'r', encoding='utf-8') as file:
+        if os.path.exists(file_path):
+            with open(file_path, 'r', encoding='utf-8') as file:
                 urls = {line.strip() for line in file if line.strip()}
-            print(f"\nЗагружено {len(urls)} URL-адресов из файла urls.txt")
+            print(f"\nЗагружено {len(urls)} URL-адресов из файла {file_path}")
             return urls
         return None
     except Exception as e:
-        print(f"\nОшибка при чтении файла urls.txt: {e}")
+        print(f"\nОшибка при чтении файла {file_path}: {e}")
         return None
 
 def determine_report_type(df):
-    columns = df.columns.tolist()
+    return report_type_from_columns(df.columns.tolist())
+
+def report_type_from_columns(columns):
     has_demand = any(col.endswith('_demand') for col in columns)
     
     try:
@@ -58,52 +272,1375 @@ def determine_report_type(df):
     else:
         return None
 
-def load_data(file_path):
+def load_data(file_path, mode=None, use_cache=True, all_metrics=False):
+    # all_metrics сохраняет колонки всех метрик, а не только нужных режиму
+    # (для истории, в которую пишется все, что есть в выгрузке)
     if not os.path.exists(file_path):
         print(f'Файл {file_path} не найден.')
-        input("\nНажмите Enter для завершения...")
         return None
-    return pd.read_excel(file_path)
 
-def add_word_count_column(df):
-    df['Кол-во слов'] = df['Query'].apply(lambda x: len(str(x).split()))
+    if use_cache:
+        entry = os.path.join(CACHE_DIR, cache_key(file_path, mode, all_metrics))
+        try:
+            df = read_cache_entry(entry)
+            if df is not None:
+                return df
+        except Exception as e:
+            # Любая ошибка чтения кэша — это промах, а не сбой обработки файла
+            print(f"\nКэш {entry} повреждён ({e}), файл будет прочитан заново")
+            shutil.rmtree(entry, ignore_errors=True)
+
+    try:
+        df = read_xlsx_columns(file_path, mode, all_metrics)
+    except (KeyError, ValueError, zipfile.BadZipFile) as e:
+        print(f"\nБыстрое чтение не удалось ({e}), используется pd.read_excel")
+        df = pd.read_excel(file_path)
+    df = compact_dtypes(df)
+
+    if use_cache:
+        try:
+            write_cache_entry(entry, df)
+            evict_cache(CACHE_DIR, CACHE_MAX_BYTES)
+        except Exception as e:
+            print(f"\nНе удалось сохранить кэш: {e}")
+    return df
+
+def compact_dtypes(df):
+    # Ежедневные метрики сжимаются до int32/float32, только если это не меняет
+    # ни одного значения (позиции вроде 3.3 в float32 не представимы точно и
+    # остаются float64, иначе разошлось бы округление средних). Текстовые
+    # колонки хранятся как категории: каждая строка Url/Query — один раз
+    data = {}
+    for name in df.columns:
+        column = df[name]
+        values = column.to_numpy()
+        if str(name).endswith(METRIC_SUFFIXES) and np.issubdtype(values.dtype, np.number):
+            if np.issubdtype(values.dtype, np.integer) or is_integral(values):
+                column = values.astype(integer_dtype(values), copy=False)
+            elif np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True):
+                column = values.astype(np.float32)
+        elif not np.issubdtype(values.dtype, np.number) and not isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype('category')
+        data[name] = column
+    return pd.DataFrame(data, index=df.index, copy=False)
+
+def is_integral(values):
+    # Целые значения без пропусков, представимые в int64: 2.5e20 тоже целое,
+    # но при приведении к int64 переполнилось бы
+    return (not np.isnan(values).any() and np.array_equal(values, np.floor(values))
+            and (len(values) == 0 or np.abs(values).max() < 2 ** 63))
+
+def integer_dtype(values):
+    if len(values) == 0 or (values.min() >= np.iinfo(np.int32).min and values.max() <= np.iinfo(np.int32).max):
+        return np.int32
+    return np.int64
+
+def full_url_column(urls, site_url):
+    # Для категорий «Полный URL» строится из таблицы уникальных адресов,
+    # а строки получают те же коды, что и Url
+    if isinstance(urls.dtype, pd.CategoricalDtype):
+        categories = site_url + urls.cat.categories.astype(str)
+        return pd.Series(pd.Categorical.from_codes(urls.cat.codes, categories), index=urls.index)
+    return site_url + urls
+
+def cache_key(file_path, mode=None, all_metrics=False):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    size = os.path.getsize(file_path)
+    return f"{digest.hexdigest()}-{size}-{mode or 'auto'}{'-all' if all_metrics else ''}-v{CACHE_VERSION}"
+
+def read_cache_entry(entry):
+    meta_path = os.path.join(entry, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, 'r', encoding='utf-8') as file:
+        meta = json.load(file)
+
+    if meta['format'] == 'arrow':
+        df = pyarrow.feather.read_table(os.path.join(entry, 'data.arrow'), memory_map=True).to_pandas()
+    else:
+        data = {}
+        for i, (name, kind) in enumerate(meta['columns']):
+            values = np.asarray(np.load(os.path.join(entry, f'{i}.npy'), mmap_mode='r'))
+            if kind == 'category':
+                values = pd.Categorical.from_codes(values, meta['categories'][str(i)])
+            elif kind == 'text':
+                categories = np.array(meta['categories'][str(i)] + [None], dtype=object)
+                values = categories[values]
+            data[name] = values
+        df = pd.DataFrame(data, copy=False)
+
+    # Время изменения записи служит отметкой последнего использования для LRU
+    os.utime(entry)
     return df
 
-def create_output_file_name(input_file, domain, mode):
+def write_cache_entry(entry, df):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_entry = f'{entry}.tmp{os.getpid()}'
+    shutil.rmtree(tmp_entry, ignore_errors=True)
+    os.makedirs(tmp_entry)
+    try:
+        meta = None
+        if pyarrow is not None:
+            arrow_path = os.path.join(tmp_entry, 'data.arrow')
+            try:
+                df.to_feather(arrow_path, compression='uncompressed')
+                meta = {'format': 'arrow', 'columns': [], 'categories': {}}
+            except (TypeError, ValueError, pyarrow.ArrowException):
+                # Arrow не принимает текстовые колонки со смешанными типами
+                # (например, числовой запрос 2024 среди строк) — такие файлы
+                # кэшируются в формате npy
+                if os.path.exists(arrow_path):
+                    os.remove(arrow_path)
+        if meta is None:
+            meta = write_npy_entry(tmp_entry, df)
+
+        with open(os.path.join(tmp_entry, 'meta.json'), 'w', encoding='utf-8') as file:
+            json.dump(meta, file, ensure_ascii=False)
+
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_entry, entry)
+    finally:
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+def write_npy_entry(tmp_entry, df):
+    columns = []
+    categories = {}
+    for i, name in enumerate(df.columns):
+        if isinstance(df[name].dtype, pd.CategoricalDtype):
+            categories[str(i)] = [value.item() if isinstance(value, np.generic) else value
+                                  for value in df[name].cat.categories]
+            values = df[name].cat.codes.to_numpy().astype(np.int32)
+            columns.append((name, 'category'))
+            np.save(os.path.join(tmp_entry, f'{i}.npy'), values)
+            continue
+        values = df[name].to_numpy()
+        if values.dtype == object or not np.issubdtype(values.dtype, np.number):
+            # Строки храним словарём: коды в .npy, уникальные значения в meta.json
+            codes, uniques = pd.factorize(df[name], use_na_sentinel=True)
+            categories[str(i)] = [value.item() if isinstance(value, np.generic) else value for value in uniques]
+            values = codes.astype(np.int32)
+            columns.append((name, 'text'))
+        else:
+            columns.append((name, 'number'))
+        np.save(os.path.join(tmp_entry, f'{i}.npy'), values)
+    return {'format': 'npy', 'columns': columns, 'categories': categories}
+
+def evict_cache(cache_dir, max_bytes):
+    entries = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if not os.path.isdir(path):
+            continue
+        size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+        entries.append((os.path.getmtime(path), size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+def xlsx_first_sheet_path(archive):
+    try:
+        workbook = archive.read('xl/workbook.xml')
+        rels = archive.read('xl/_rels/workbook.xml.rels')
+    except KeyError:
+        return 'xl/worksheets/sheet1.xml'
+    sheet = next(fromstring(workbook).iter(XLSX_NS + 'sheet'))
+    rel_id = sheet.get(XLSX_REL_NS + 'id')
+    for rel in fromstring(rels).iter('{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'):
+        if rel.get('Id') == rel_id:
+            target = rel.get('Target')
+            if target.startswith('/'):
+                return target.lstrip('/')
+            return posixpath.normpath(posixpath.join('xl', target))
+    return 'xl/worksheets/sheet1.xml'
+
+def xlsx_shared_strings(archive):
+    try:
+        source = archive.open('xl/sharedStrings.xml')
+    except KeyError:
+        return []
+    strings = []
+    with source:
+        for _, elem in iterparse(source, events=('end',)):
+            if elem.tag == XLSX_NS + 'si':
+                # Текст может быть разбит на несколько форматированных фрагментов <r><t>
+                strings.append(''.join(t.text or '' for t in elem.iter(XLSX_NS + 't')))
+                elem.clear()
+    return strings
+
+@lru_cache(maxsize=None)
+def column_index(letters):
+    index = 0
+    for char in letters:
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+def column_letters(index):
+    letters = ''
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(65 + rest) + letters
+    return letters
+
+XLSX_CELL_RE = re.compile(
+    rb'<c r="([A-Z]+)(\d+)"(?:\s+s="\d+")?(?:\s+t="(\w+)")?(?:\s+s="\d+")?\s*'
+    rb'(?:/>|>(?:<f\b[^>]*/>|<f\b[^>]*>[^<]*</f>)?(?:<v>([^<]*)</v>)?(?:<is>(.*?)</is>)?</c>)',
+    re.S,
+)
+XLSX_TAG_RE = re.compile(rb'<[^>]+>')
+# Фрагменты обычной числовой ячейки <c r="A1" s="1"><v>1</v></c>, прочитанные
+# как целые числа, и наибольшая длина значения для векторного разбора
+XLSX_PLAIN_REF = np.frombuffer(b' r="', dtype=np.uint32)[0]
+XLSX_PLAIN_STYLE = np.frombuffer(b' s="', dtype=np.uint32)[0]
+XLSX_PLAIN_VALUE = np.frombuffer(b'><v>', dtype=np.uint32)[0]
+XLSX_PLAIN_CLOSE = np.frombuffer(b'</v></c>', dtype=np.uint64)[0]
+XLSX_PLAIN_NUMBER = np.frombuffer(b' t="n"', dtype=np.uint8)
+XLSX_PLAIN_PAD = 32
+
+def xlsx_text(raw):
+    return unescape(XLSX_TAG_RE.sub(b'', raw).decode('utf-8'))
+
+def xlsx_plain_cells(block, fast_columns):
+    # Векторный разбор обычных числовых ячеек вида <c r="AB12" s="1"><v>3.5</v></c>:
+    # границы тегов ищутся по байтам блока средствами NumPy, а адреса и значения
+    # разбираются сразу для всех таких ячеек блока, без объектов Python на
+    # каждую ячейку. fast_columns отмечает колонки, где такой разбор допустим
+    # (в текстовых колонках число должно остаться значением ячейки как есть).
+    # Возвращает колонки, строки и значения разобранных ячеек и начала остальных
+    data = np.frombuffer(block + bytes(XLSX_PLAIN_PAD), dtype=np.uint8)
+    windows = np.lib.stride_tricks.sliding_window_view(data, XLSX_PLAIN_PAD)
+    tags = np.flatnonzero(data[:len(block)] == ord('<'))
+    quotes = np.flatnonzero(data == ord('"'))
+    starts = tags[(data[tags + 1] == ord('c')) & np.isin(data[tags + 2], (ord(' '), ord('>'), ord('/')))]
+    nothing = np.empty(0, dtype=np.int64)
+    if not len(starts):
+        return nothing, nothing, np.empty(0), starts
+
+    # Адрес: 1–3 заглавные буквы и 1–7 цифр до закрывающей кавычки
+    plain = windows[starts + 2, :4].copy().view(np.uint32)[:, 0] == XLSX_PLAIN_REF
+    ref = windows[starts + 6, :10].astype(np.int64)
+    upper = (ref >= ord('A')) & (ref <= ord('Z'))
+    num_letters = np.logical_and.accumulate(upper[:, :3], axis=1).sum(axis=1)
+    ref_end = quotes[np.minimum(np.searchsorted(quotes, starts + 6), len(quotes) - 1)]
+    ref_length = ref_end - starts - 6
+    offsets = np.arange(ref.shape[1])
+    in_digits = (offsets >= num_letters[:, None]) & (offsets < ref_length[:, None])
+    is_digit = (ref >= ord('0')) & (ref <= ord('9'))
+    plain &= (num_letters > 0) & (ref_length - num_letters > 0) & (ref_length - num_letters <= 7)
+    plain &= np.all(is_digit | ~in_digits, axis=1)
+
+    # После адреса — сразу конец тега или только атрибуты s="..." и t="n"
+    styled = windows[ref_end + 1, :4].copy().view(np.uint32)[:, 0] == XLSX_PLAIN_STYLE
+    style_end = quotes[np.minimum(np.searchsorted(quotes, ref_end + 5), len(quotes) - 1)]
+    ends = np.where(styled, style_end + 1, ref_end + 1)
+    ends += np.all(windows[ends, :6] == XLSX_PLAIN_NUMBER, axis=1) * 6
+    plain &= windows[ends, :4].copy().view(np.uint32)[:, 0] == XLSX_PLAIN_VALUE
+    value_starts = ends + 4
+    value_ends = tags[np.minimum(np.searchsorted(tags, value_starts), len(tags) - 1)]
+    lengths = value_ends - value_starts
+    plain &= windows[value_ends, :8].copy().view(np.uint64)[:, 0] == XLSX_PLAIN_CLOSE
+    plain &= (lengths > 0) & (lengths <= XLSX_PLAIN_PAD)
+
+    columns = np.zeros(len(starts), dtype=np.int64)
+    rows = np.zeros(len(starts), dtype=np.int64)
+    for offset in range(3):
+        columns = np.where(offset < num_letters, columns * 26 + ref[:, offset] - ord('A') + 1, columns)
+    for offset in range(ref.shape[1]):
+        rows = np.where(in_digits[:, offset], rows * 10 + ref[:, offset] - ord('0'), rows)
+    columns -= 1
+    plain &= np.append(fast_columns, True)[np.minimum(columns, len(fast_columns))]
+
+    # Значения собираются в строки фиксированной ширины и переводятся в числа одним astype
+    width = int(lengths[plain].max()) if plain.any() else 1
+    values = windows[value_starts[plain], :width].copy()
+    values[np.arange(width) >= lengths[plain][:, None]] = 0
+    try:
+        numbers = values.view(f'S{width}').ravel().astype(np.float64)
+    except ValueError:
+        return nothing, nothing, np.empty(0), starts
+    return columns[plain], rows[plain], numbers, starts[~plain]
+
+def xlsx_block_cells(block, next_row, fast_columns=None):
+    # Обычные числовые ячейки разбираются векторно (если известны колонки,
+    # где это допустимо), остальные — одним регулярным выражением. Если
+    # какие-то ячейки ему не подошли (префиксы пространств имён, нет атрибута
+    # r и т.п.), блок разбирается через ElementTree
+    empty = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0))
+    if fast_columns is not None:
+        columns, rows, numbers, other = xlsx_plain_cells(block, fast_columns)
+        cells = [XLSX_CELL_RE.match(block, start) for start in other.tolist()]
+        if all(cells):
+            cells = [cell.groups(b'') for cell in cells]
+            if len(numbers) or cells:
+                next_row = max(int(rows.max()) if len(rows) else 0, int(cells[-1][1]) if cells else 0)
+            return (columns, rows, numbers), cells, next_row
+    cells = XLSX_CELL_RE.findall(block)
+    if len(cells) == block.count(b'<c ') + block.count(b'<c>') + block.count(b'<c/>'):
+        if cells:
+            next_row = int(cells[-1][1])
+        return empty, cells, next_row
+    cells = []
+    for row in fromstring(block):
+        ref = row.get('r')
+        next_row = int(ref) if ref else next_row + 1
+        row_ref = str(next_row).encode()
+        position = 0
+        for cell in row:
+            ref = cell.get('r')
+            if ref:
+                position = column_index(ref.rstrip('0123456789'))
+            value = cell.findtext(XLSX_NS + 'v')
+            inline = ''.join(t.text or '' for t in cell.iter(XLSX_NS + 't'))
+            cells.append((
+                column_letters(position).encode(),
+                row_ref,
+                (cell.get('t') or '').encode(),
+                escape(value).encode() if value is not None else b'',
+                escape(inline).encode(),
+            ))
+            position += 1
+    return empty, cells, next_row
+
+def xlsx_text_values(types, values, inline, shared_strings):
+    result = np.empty(len(types), dtype=object)
+    for i, (cell_type, value) in enumerate(zip(types, values)):
+        if cell_type == b's':
+            result[i] = shared_strings[int(value)]
+        elif cell_type == b'inlineStr':
+            result[i] = xlsx_text(inline[i])
+        elif cell_type == b'str':
+            result[i] = xlsx_text(value)
+        elif cell_type == b'b':
+            result[i] = value == b'1'
+        elif cell_type == b'e' or not value:
+            result[i] = None
+        else:
+            number = float(value)
+            result[i] = int(number) if number.is_integer() and b'.' not in value and b'E' not in value else number
+    return result
+
+def iter_xlsx_row_blocks(source, block_size=1 << 22):
+    # Лист читается блоками целых строк, поэтому в памяти одновременно
+    # находится только небольшой фрагмент XML
+    buffer = b''
+    while True:
+        match = re.search(rb'<((?:[\w.-]+:)?)sheetData(\s[^>]*)?(/?)>', buffer)
+        if match:
+            break
+        chunk = source.read(block_size)
+        if not chunk:
+            raise ValueError('в листе не найден элемент sheetData')
+        buffer += chunk
+
+    preamble = buffer[:match.start()]
+    root = re.search(rb'<((?:[\w.-]+:)?worksheet)\b[^>]*>', preamble)
+    if root is None:
+        raise ValueError('в листе не найден элемент worksheet')
+    dimension = re.search(rb'<(?:[\w.-]+:)?dimension\s+ref="[A-Z]*\d+:?[A-Z]*(\d+)"', preamble)
+    yield int(dimension.group(1)) if dimension else 0
+    if match.group(3):
+        return
+
+    prefix = match.group(1)
+    row_close = b'</' + prefix + b'row>'
+    data_close = b'</' + prefix + b'sheetData>'
+    wrapper_open = root.group(0)
+    wrapper_close = b'</' + root.group(1) + b'>'
+    buffer = buffer[match.end():]
+
+    finished = False
+    header = True
+    while not finished:
+        chunk = source.read(block_size)
+        if chunk:
+            buffer += chunk
+        end = buffer.find(data_close)
+        if header:
+            # Первая строка отдается отдельным блоком: по заголовку определяется
+            # раскладка колонок еще до разбора остальных строк
+            cut = buffer.find(row_close, 0, len(buffer) if end == -1 else end)
+            if cut != -1:
+                cut += len(row_close)
+                header = False
+                yield wrapper_open + buffer[:cut] + wrapper_close
+                buffer = buffer[cut:]
+                end = buffer.find(data_close)
+        if end != -1:
+            block, finished = buffer[:end], True
+        elif not chunk:
+            raise ValueError('лист обрывается до конца sheetData')
+        else:
+            cut = buffer.rfind(row_close)
+            if cut == -1:
+                continue
+            cut += len(row_close)
+            block, buffer = buffer[:cut], buffer[cut:]
+        if block.strip():
+            yield wrapper_open + block + wrapper_close
+
+def iter_xlsx_blocks(file_path, mode=None, all_metrics=False):
+    # Первым значением отдаётся раскладка колонок, затем для каждого блока строк
+    # листа — номер первой строки и массивы значений этого блока. Ненужные
+    # режиму колонки метрик пропускаются ещё до разбора значений
+    with zipfile.ZipFile(file_path) as archive:
+        shared_strings = xlsx_shared_strings(archive)
+        sheet_path = xlsx_first_sheet_path(archive)
+        with archive.open(sheet_path) as source:
+            row_blocks = iter_xlsx_row_blocks(source)
+            dimension_rows = next(row_blocks)
+            layout = None
+            next_row = 0
+            fast_columns = None
+
+            for block in row_blocks:
+                plain, cells, next_row = xlsx_block_cells(block, next_row, fast_columns)
+                plain_columns, plain_rows, numbers = plain
+                if not cells and not len(numbers):
+                    continue
+                if cells:
+                    letters, rows, types, values, inline = zip(*cells)
+                    cell_columns = np.array([column_index(key.decode()) for key in letters], dtype=np.int64)
+                    rows = np.array(rows).astype(np.int64)
+                    types = np.array(types, dtype=object)
+                    values = np.array(values, dtype=object)
+                else:
+                    cell_columns = rows = np.empty(0, dtype=np.int64)
+                    types = values = np.empty(0, dtype=object)
+                    inline = ()
+
+                if layout is None:
+                    header_row = rows[0]
+                    first = np.flatnonzero(rows == header_row)
+                    names = xlsx_text_values(types[first], values[first], [inline[i] for i in first], shared_strings)
+                    header = {int(cell_columns[i]): str(name) for i, name in zip(first, names) if name is not None}
+
+                    columns = [header[i] for i in sorted(header)]
+                    if mode is None:
+                        mode = report_type_from_columns(columns)
+                    suffixes = METRIC_SUFFIXES if all_metrics else MODE_SUFFIXES.get(mode, METRIC_SUFFIXES)
+                    numeric_names = [name for name in columns if name.endswith(suffixes)]
+                    text_names = [name for name in columns if not name.endswith(METRIC_SUFFIXES)]
+                    # Номер колонки листа → номер строки в массивах numeric и text
+                    # (текстовые идут после числовых), -1 — колонка не нужна
+                    slot_of = np.full(max(header) + 2, -1)
+                    for i, name in header.items():
+                        if name in numeric_names:
+                            slot_of[i] = numeric_names.index(name)
+                        elif name in text_names:
+                            slot_of[i] = len(numeric_names) + text_names.index(name)
+                    fast_columns = slot_of[:-1] < len(numeric_names)
+                    layout = {
+                        'columns': columns,
+                        'numeric': numeric_names,
+                        'text': text_names,
+                        'rows': max(dimension_rows - header_row, 0),
+                    }
+                    yield layout
+
+                slots = slot_of[np.minimum(cell_columns, len(slot_of) - 1)]
+                positions = rows - header_row - 1
+                keep = (slots >= 0) & (positions >= 0) & ((values != b'') | (types == b'inlineStr'))
+                plain_slots = slot_of[np.minimum(plain_columns, len(slot_of) - 1)]
+                plain_positions = plain_rows - header_row - 1
+                plain_keep = (plain_slots >= 0) & (plain_positions >= 0)
+                kept = np.concatenate([positions[keep], plain_positions[plain_keep]])
+                if not len(kept):
+                    continue
+                start = kept.min()
+                size = kept.max() + 1 - start
+                positions = positions - start
+                numeric = np.full((len(numeric_names), size), np.nan)
+                text = np.full((len(text_names), size), None, dtype=object)
+                present = np.zeros(size, dtype=bool)
+
+                numeric[plain_slots[plain_keep], plain_positions[plain_keep] - start] = numbers[plain_keep]
+                to_numeric = keep & (slots < len(numeric_names)) & ((types == b'') | (types == b'n'))
+                if to_numeric.any():
+                    numeric[slots[to_numeric], positions[to_numeric]] = values[to_numeric].astype(np.bytes_).astype(np.float64)
+                to_text = np.flatnonzero(keep & ~to_numeric)
+                if len(to_text):
+                    converted = xlsx_text_values(types[to_text], values[to_text], [inline[i] for i in to_text], shared_strings)
+                    is_metric = slots[to_text] < len(numeric_names)
+                    for i, value in zip(to_text[is_metric], converted[is_metric]):
+                        try:
+                            numeric[slots[i], positions[i]] = float(value)
+                        except (TypeError, ValueError):
+                            pass
+                    is_text = to_text[~is_metric]
+                    text[slots[is_text] - len(numeric_names), positions[is_text]] = converted[~is_metric]
+                present[kept - start] = True
+                yield start, numeric, text, present
+
+    if layout is None:
+        raise ValueError('лист не содержит данных')
+
+def xlsx_frame(layout, numeric, text, present, first_row=0):
+    # Полностью пустые строки в результат не попадают
+    rows = np.flatnonzero(present)
+    data = {}
+    for name in layout['columns']:
+        if name in layout['numeric']:
+            column = numeric[layout['numeric'].index(name), rows]
+            if is_integral(column):
+                # Целые значения без пропусков сразу храним как целые, как это делает pd.read_excel
+                column = column.astype(integer_dtype(column))
+            data[name] = column
+        elif name in layout['text']:
+            data[name] = text[layout['text'].index(name), rows]
+    return pd.DataFrame(data, index=pd.RangeIndex(first_row, first_row + len(rows)), copy=False)
+
+def read_xlsx_columns(file_path, mode=None, all_metrics=False):
+    # Значения ячеек разбираются векторно и сразу раскладываются в заранее
+    # выделенные массивы NumPy
+    blocks = iter_xlsx_blocks(file_path, mode, all_metrics)
+    layout = next(blocks)
+    capacity = max(layout['rows'], 1024)
+    numeric = np.full((len(layout['numeric']), capacity), np.nan)
+    text = np.full((len(layout['text']), capacity), None, dtype=object)
+    present = np.zeros(capacity, dtype=bool)
+    last_row = 0
+
+    for start, block_numeric, block_text, block_present in blocks:
+        end = start + len(block_present)
+        if end > capacity:
+            grow = max(capacity, end - capacity)
+            numeric = np.concatenate([numeric, np.full((numeric.shape[0], grow), np.nan)], axis=1)
+            text = np.concatenate([text, np.full((text.shape[0], grow), None, dtype=object)], axis=1)
+            present = np.concatenate([present, np.zeros(grow, dtype=bool)])
+            capacity += grow
+        numeric[:, start:end] = block_numeric
+        text[:, start:end] = block_text
+        present[start:end] = block_present
+        last_row = max(last_row, end)
+
+    return xlsx_frame(layout, numeric, text, present[:last_row])
+
+def iter_xlsx_chunks(file_path, mode=None, chunk_rows=100000, all_metrics=False):
+    # Потоковое чтение кусками примерно по chunk_rows строк: в памяти
+    # одновременно находится только текущий кусок
+    blocks = iter_xlsx_blocks(file_path, mode, all_metrics)
+    layout = next(blocks)
+    pending = []
+    pending_rows = 0
+    first_row = 0
+    yielded = False
+    for _, block_numeric, block_text, block_present in blocks:
+        pending.append((block_numeric, block_text, block_present))
+        pending_rows += int(block_present.sum())
+        if pending_rows >= chunk_rows:
+            yield compact_dtypes(xlsx_frame(layout, *(np.concatenate(parts, axis=-1) for parts in zip(*pending)), first_row))
+            first_row += pending_rows
+            pending = []
+            pending_rows = 0
+            yielded = True
+    if pending or not yielded:
+        # Даже для листа без данных отдаём один пустой кусок с колонками
+        empty = (np.empty((len(layout['numeric']), 0)), np.empty((len(layout['text']), 0), dtype=object), np.zeros(0, dtype=bool))
+        parts = [np.concatenate(part, axis=-1) for part in zip(*pending)] if pending else empty
+        yield compact_dtypes(xlsx_frame(layout, *parts, first_row))
+
+def position_stats(positions, percentiles=()):
+    # Нули означают, что запрос в этот день не показывался, поэтому маскируются
+    # в NaN один раз для всех статистик
+    values = np.array(positions, dtype=np.float64)
+    zeros = values == 0
+    values[zeros] = np.nan
+    missing = np.isnan(values)
+    counts = values.shape[1] - np.count_nonzero(missing, axis=1)
+
+    # Порядок суммирования повторяет прежний построчный Series.mean, чтобы
+    # средние совпадали до последнего бита: строки без нулей суммировались
+    # попарно (float64), строки с нулями — строго слева направо (object)
+    filled = np.where(missing, 0.0, values)
+    totals = filled.sum(axis=1)
+    sequential = zeros.any(axis=1)
+    if sequential.any():
+        rows = filled[sequential]
+        ordered = np.zeros(len(rows))
+        for day in range(rows.shape[1]):
+            ordered += rows[:, day]
+        totals[sequential] = ordered
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        stats = {
+            'count': counts,
+            'mean': totals / np.where(counts > 0, counts, np.nan),
+            'median': np.nanmedian(values, axis=1) if values.shape[1] else np.full(len(values), np.nan),
+        }
+        for q in percentiles:
+            stats[f'p{q:g}'] = np.nanpercentile(values, q, axis=1)
+    return stats
+
+@lru_cache(maxsize=None)
+def compile_metrics(names):
+    # План расчета: какие свертки нужны для метрик names. Суммы нужны для
+    # 'sum', 'mean' (сумма / число дней) и 'ratio'; позиционные статистики
+    # (с маскированием нулей) считаются одним вызовом position_stats
+    sums, masked = [], []
+    for name in names:
+        metric = METRICS[name]
+        target = masked if metric.mask_zeros else sums
+        if metric.reduction == 'median' and not metric.mask_zeros:
+            raise ValueError(f'Медиана без маскирования нулей не поддерживается: {name}')
+        for suffix in metric.inputs:
+            if suffix not in target:
+                target.append(suffix)
+    return tuple(sums), tuple(masked)
+
+def daily_arrays(df, suffixes):
+    # Массивы строки × дни для каждого суффикса, дни по порядку дат. Тип
+    # данных сохраняется: суммы целых остаются целыми, а float32 — float32,
+    # как при прежнем расчете через pandas
+    return {suffix: df[daily_columns(df, suffix)].to_numpy() for suffix in suffixes}
+
+def daily_sums(values):
+    # Сумма и число дней с данными; пропуски (NaN) не учитываются. Порядок
+    # суммирования повторяет pandas, чтобы дробные суммы совпадали до бита:
+    # без пропусков массив суммируется как есть, а с пропусками — копия в
+    # порядке строк (copy), в которой NaN заменены нулями
+    if values.dtype.kind == 'f':
+        missing = np.isnan(values)
+        if missing.any():
+            filled = values.copy()
+            filled[missing] = 0
+            return filled.sum(axis=1), values.shape[1] - missing.sum(axis=1)
+    return values.sum(axis=1), values.shape[1]
+
+def compute_metrics(arrays, names):
+    sum_suffixes, masked_suffixes = compile_metrics(tuple(names))
+    sums = {suffix: daily_sums(arrays[suffix]) for suffix in sum_suffixes}
+    stats = {suffix: position_stats(arrays[suffix]) for suffix in masked_suffixes}
+
+    results = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name in names:
+            metric = METRICS[name]
+            suffix = metric.inputs[0]
+            if metric.mask_zeros:
+                values = stats[suffix][metric.reduction]
+            elif metric.reduction == 'sum':
+                values = sums[suffix][0]
+            elif metric.reduction == 'mean':
+                total, count = sums[suffix]
+                values = total / count
+            elif metric.reduction == 'ratio':
+                values = sums[suffix][0] / sums[metric.inputs[1]][0] * 100
+            else:
+                raise ValueError(f'Неизвестная свертка {metric.reduction} у метрики {name}')
+            if metric.decimals is not None:
+                values = np.round(values, metric.decimals)
+            if metric.mask_zeros:
+                values = np.nan_to_num(values, nan=0.0)
+            results[name] = values
+    return results
+
+def add_metric_columns(df, names, arrays):
+    for name, values in compute_metrics(arrays, names).items():
+        df[name] = pd.Series(values, index=df.index)
+    return df
+
+def round_position(values, index=None):
+    return pd.Series(np.round(values, 1), index=index).fillna(0)
+
+def tokenize_queries(queries):
+    # Один проход разбиения на слова для всего столбца. Слова кодируются номерами
+    # в словаре, а rows хранит позицию запроса каждого слова, поэтому один и тот же
+    # поток токенов обслуживает и «Кол-во слов», и «Статистику слов»
+    if isinstance(queries.dtype, pd.CategoricalDtype):
+        # Разбиваем только уникальные запросы, а строки получают их токены по кодам
+        tokens = tokenize_queries(pd.Series(list(queries.cat.categories) + [np.nan], dtype=object))
+        query_codes = queries.cat.codes.to_numpy().astype(np.int64)
+        query_codes[query_codes < 0] = len(queries.cat.categories)
+        lengths = tokens.lengths[query_codes]
+        starts = (np.cumsum(tokens.lengths) - tokens.lengths)[query_codes]
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        codes = tokens.codes[np.repeat(starts, lengths) + offsets]
+        rows = np.repeat(np.arange(len(queries)), lengths)
+        return TokenStream(tokens.vocabulary, codes, rows, lengths, queries.index)
+
+    words = [str(query).split() for query in queries.tolist()]
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    codes, vocabulary = pd.factorize(np.array(list(chain.from_iterable(words)), dtype=object))
+    rows = np.repeat(np.arange(len(words)), lengths)
+    return TokenStream(vocabulary, codes, rows, lengths, queries.index)
+
+# Окончания для встроенного стеммера: русский алгоритм Snowball. Окончания
+# первых групп отбрасываются, только если перед ними стоит «а» или «я»
+RU_VOWELS = 'аеиоуыэюя'
+RU_PERFECTIVE_GERUND = (('в', 'вши', 'вшись'), ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'))
+RU_ADJECTIVE = ((), ('ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'его', 'ого',
+                     'ему', 'ому', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею'))
+RU_PARTICIPLE = (('ем', 'нн', 'вш', 'ющ', 'щ'), ('ивш', 'ывш', 'ующ'))
+RU_REFLEXIVE = ((), ('ся', 'сь'))
+RU_VERB = (('ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но', 'ет', 'ют', 'ны', 'ть', 'ешь', 'нно'),
+           ('ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ило',
+            'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю'))
+RU_NOUN = ((), ('а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и', 'ией', 'ей', 'ой', 'ий', 'й',
+                'иям', 'ям', 'ием', 'ем', 'ам', 'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия',
+                'ья', 'я'))
+RU_DERIVATIONAL = ((), ('ост', 'ость'))
+RU_SUPERLATIVE = ((), ('ейш', 'ейше'))
+CYRILLIC_RE = re.compile('[а-я]')
+WORD_EDGE_RE = re.compile(r'^[\W_]+|[\W_]+$')
+
+def ru_strip(word, start, endings):
+    # Самое длинное окончание из обеих групп, целиком лежащее в word[start:].
+    # Как и в Snowball, если условие для найденного окончания не выполнено,
+    # более короткие окончания уже не пробуются
+    conditional, plain = endings
+    for ending in sorted(conditional + plain, key=len, reverse=True):
+        if word.endswith(ending) and len(word) - len(ending) >= start:
+            cut = len(word) - len(ending)
+            if ending in plain:
+                return word[:cut]
+            if cut > start and word[cut - 1] in 'ая':
+                return word[:cut]
+            return None
+    return None
+
+def ru_region(word, start):
+    # Позиция после первой согласной, следующей за гласной (начиная со start)
+    for i in range(start + 1, len(word)):
+        if word[i] not in RU_VOWELS and word[i - 1] in RU_VOWELS:
+            return i + 1
+    return len(word)
+
+def stem_russian(word):
+    rv = next((i + 1 for i, char in enumerate(word) if char in RU_VOWELS), len(word))
+    r2 = ru_region(word, ru_region(word, 0))
+
+    stripped = ru_strip(word, rv, RU_PERFECTIVE_GERUND)
+    if stripped is None:
+        word = ru_strip(word, rv, RU_REFLEXIVE) or word
+        stripped = ru_strip(word, rv, RU_ADJECTIVE)
+        if stripped is not None:
+            stripped = ru_strip(stripped, rv, RU_PARTICIPLE) or stripped
+        else:
+            stripped = ru_strip(word, rv, RU_VERB)
+            if stripped is None:
+                stripped = ru_strip(word, rv, RU_NOUN)
+    if stripped is not None:
+        word = stripped
+
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+    word = ru_strip(word, max(rv, r2), RU_DERIVATIONAL) or word
+
+    superlative = ru_strip(word, rv, RU_SUPERLATIVE)
+    if superlative is not None:
+        word = superlative
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        word = word[:-1]
+    elif superlative is None and word.endswith('ь') and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+def stem_english(word):
+    # Легкий стеммер: множественное число, притяжательная форма, -ing и -ed
+    if word.endswith("'s"):
+        word = word[:-2]
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('sses'):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')) and len(word) > 3:
+        return word[:-1]
+    for suffix in ('ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3 and re.search('[aeiouy]', word[:-len(suffix)]):
+            return word[:-len(suffix)]
+    return word
+
+if snowballstemmer is not None:
+    stem_russian = snowballstemmer.stemmer('russian').stemWord
+    stem_english = snowballstemmer.stemmer('english').stemWord
+
+def clean_word(word):
+    # Регистр, «ё» и знаки препинания по краям слова («Купить,» → «купить»);
+    # дефисы и точки внутри слова («wi-fi», «2.0») сохраняются
+    return WORD_EDGE_RE.sub('', str(word).lower().replace('ё', 'е'))
+
+@lru_cache(maxsize=None)
+def normalize_word(word):
+    # Основа слова. Кэш нужен, потому что в пакетном режиме и при обработке
+    # кусками одни и те же слова встречаются во многих словарях
+    word = clean_word(word)
+    if CYRILLIC_RE.search(word):
+        return stem_russian(word)
+    if word.isascii() and word.isalpha():
+        return stem_english(word)
+    return word
+
+def normalize_word_counts(word_count_df):
+    # Словоформы одного слова складываются в одну строку: «Слово» — самая
+    # частая форма, «Формы» — все встретившиеся формы. Стеммер вызывается один
+    # раз на уникальное слово, а не на каждое вхождение
+    forms = word_count_df['Слово'].map(clean_word)
+    counts = word_count_df['Количество'].groupby(forms.to_numpy(), sort=False).sum()
+    counts = counts[counts.index != '']
+    stems = counts.index.map(normalize_word)
+    by_form = pd.DataFrame({'Форма': counts.index, 'Количество': counts.to_numpy(), 'Основа': stems})
+    by_form = by_form.sort_values('Количество', ascending=False, kind='stable')
+    grouped = by_form.groupby('Основа', sort=False)
+    result = pd.DataFrame({
+        'Слово': grouped['Форма'].first(),
+        'Количество': grouped['Количество'].sum(),
+        'Формы': grouped['Форма'].agg(lambda forms: ', '.join(forms) if len(forms) > 1 else ''),
+    })
+    return result.reset_index(drop=True)
+
+def sort_word_counts(word_count_df):
+    # Слова с равным количеством — по алфавиту, чтобы порядок не зависел от
+    # того, в каком порядке слова встретились (при обработке кусками он другой)
+    return word_count_df.sort_values(by=['Количество', 'Слово'], ascending=[False, True], ignore_index=True)
+
+def load_dictionaries(file_path=DICTIONARIES_FILE, brands=None):
+    # Словари из файла заменяют встроенные целиком, ключи те же, что в
+    # DEFAULT_DICTIONARIES; бренды из --brands добавляются к брендам из файла
+    dictionaries = {name: list(entries) for name, entries in DEFAULT_DICTIONARIES.items()}
+    if file_path and os.path.exists(file_path):
+        with open(file_path, encoding='utf-8') as file:
+            loaded = json.load(file)
+        unknown = set(loaded) - set(DEFAULT_DICTIONARIES)
+        if unknown:
+            raise ValueError(f"Неизвестные словари в {file_path}: {', '.join(sorted(unknown))}")
+        if not all(isinstance(entries, list) for entries in loaded.values()):
+            raise ValueError(f"Словари в {file_path} должны быть списками строк")
+        dictionaries.update({name: [str(entry) for entry in entries] for name, entries in loaded.items()})
+        print(f"\nЗагружены словари из файла {file_path}")
+    if brands:
+        dictionaries['brand'] += brands
+    return dictionaries
+
+def parse_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+def compile_dictionaries(dictionaries):
+    # Все словари сводятся в таблицы «слово → битовая маска словарей» и
+    # «основа → битовая маска» и список фраз из нескольких слов, так что каждое
+    # слово запросов проверяется сразу по всем словарям одним поиском в словаре.
+    # Слово ищется в точности как записано; по основе, то есть во всех
+    # словоформах, — только если в словаре после него стоит «*» («яндекс*»).
+    # Основы коротких слов совпадают с другими словами («рядом» → «ряд»),
+    # поэтому по умолчанию их не выводим
+    bits = {name: 1 << i for i, name in enumerate(DEFAULT_DICTIONARIES)}
+    words, stems, prefixes, phrases = {}, {}, set(), {}
+    for name, entries in dictionaries.items():
+        for entry in entries:
+            entry = str(entry).strip()
+            parts = tuple(part for part in map(clean_word, entry.split()) if part)
+            if len(parts) == 1 and entry.endswith('*'):
+                stem = normalize_word(parts[0])
+                stems[stem] = stems.get(stem, 0) | bits[name]
+                # Английский стеммер меняет окончания («happy» → «happi»),
+                # поэтому началом слова считается и основа, и само слово
+                prefixes |= {stem, parts[0]}
+            elif len(parts) == 1:
+                words[parts[0]] = words.get(parts[0], 0) | bits[name]
+            elif parts:
+                phrases[parts] = phrases.get(parts, 0) | bits[name]
+    return QueryMatcher(words, stems, tuple(prefixes), compile_phrases(phrases), bits)
+
+def compile_phrases(phrases):
+    # Фразы из нескольких слов собираются в префиксное дерево по словам.
+    # Переход «узел → слово» хранится ключом узел * число слов + номер слова,
+    # чтобы все переходы одного шага искались одним поиском в индексе
+    part_ids, edges, node_bits = {}, {}, [0]
+    for parts, phrase_bits in phrases.items():
+        node = 0
+        for part in parts:
+            edge = (node, part_ids.setdefault(part, len(part_ids)))
+            if edge not in edges:
+                edges[edge] = len(node_bits)
+                node_bits.append(0)
+            node = edges[edge]
+        node_bits[node] |= phrase_bits
+    keys = np.array([node * len(part_ids) + part for node, part in edges], dtype=np.int64)
+    return PhraseTrie(part_ids, pd.Index(keys), np.array(list(edges.values()), dtype=np.int64),
+                      np.array(node_bits, dtype=np.int64), max(map(len, phrases), default=0))
+
+def clean_vocabulary(vocabulary):
+    cleaned = pd.Series(vocabulary, dtype=object).astype(str).str.lower().str.replace('ё', 'е')
+    return cleaned.str.replace(WORD_EDGE_RE, '', regex=True)
+
+def classify_vocabulary(cleaned, matcher):
+    # Маска словарей для каждого слова словаря запросов. Основа слова почти
+    # всегда — его начало, поэтому стеммер вызывается только для слов,
+    # начинающихся с одной из основ словарей
+    word_bits = np.zeros(len(cleaned), dtype=np.int64)
+    if not len(cleaned):
+        return word_bits
+    if matcher.words:
+        word_bits |= cleaned.map(matcher.words).fillna(0).to_numpy(dtype=np.int64)
+    if matcher.stems:
+        candidates = np.flatnonzero(cleaned.str.startswith(matcher.prefixes).to_numpy(dtype=bool))
+        for i in candidates:
+            word_bits[i] |= matcher.stems.get(normalize_word(cleaned.iat[i]), 0)
+    return word_bits
+
+def classify_phrases(tokens, cleaned, matcher):
+    # Фраза найдена, если ее слова (без приведения к основе) стоят в потоке
+    # токенов подряд в пределах одного запроса. Дерево фраз проходится сразу
+    # от всех слов потока, с которых начинается какая-то фраза: шаг — один
+    # поиск переходов в индексе, шагов не больше длины самой длинной фразы,
+    # поэтому время не зависит от числа фраз в словарях
+    trie = matcher.phrases
+    row_bits = np.zeros(len(tokens.lengths), dtype=np.int64)
+    parts = cleaned.map(trie.parts).fillna(-1).to_numpy(dtype=np.int64)[tokens.codes]
+    starts = np.flatnonzero(parts >= 0)
+    nodes = np.zeros(len(starts), dtype=np.int64)
+    for offset in range(trie.depth):
+        positions = starts + offset
+        keep = positions < len(parts)
+        starts, nodes, positions = starts[keep], nodes[keep], positions[keep]
+        keep = (parts[positions] >= 0) & (tokens.rows[positions] == tokens.rows[starts])
+        starts, nodes, positions = starts[keep], nodes[keep], positions[keep]
+        edges = trie.edges.get_indexer(nodes * len(trie.parts) + parts[positions])
+        keep = edges >= 0
+        starts, nodes = starts[keep], trie.children[edges[keep]]
+        if not len(starts):
+            break
+        np.bitwise_or.at(row_bits, tokens.rows[starts], trie.bits[nodes])
+    return row_bits
+
+def add_intent_columns(df, tokens, dictionaries=None):
+    matcher = compile_dictionaries(DEFAULT_DICTIONARIES if dictionaries is None else dictionaries)
+    cleaned = clean_vocabulary(tokens.vocabulary)
+    row_bits = np.zeros(len(tokens.lengths), dtype=np.int64)
+    np.bitwise_or.at(row_bits, tokens.rows, classify_vocabulary(cleaned, matcher)[tokens.codes])
+    if matcher.phrases.depth:
+        row_bits |= classify_phrases(tokens, cleaned, matcher)
+    row_bits = pd.Series(row_bits, index=tokens.index).reindex(df.index).to_numpy()
+
+    df['Бренд'] = pd.Categorical(np.where(row_bits & matcher.bits['brand'], 'Да', 'Нет'), categories=['Да', 'Нет'])
+    labels = list(INTENT_LABELS.values()) + [INTENT_UNKNOWN]
+    intent = np.select([row_bits & matcher.bits[name] > 0 for name in INTENT_LABELS],
+                       np.arange(len(INTENT_LABELS)), len(INTENT_LABELS))
+    df['Интент'] = pd.Categorical.from_codes(intent, categories=labels)
+    return df
+
+def select_tokens(tokens, index):
+    selected = np.zeros(len(tokens.lengths), dtype=bool)
+    selected[tokens.index.get_indexer(index)] = True
+    return selected[tokens.rows]
+
+def daily_columns(df, suffix):
+    # Колонки метрики в порядке дат, а не в порядке следования в файле
+    return sorted((col for col in df.columns if col.endswith(suffix)), key=lambda col: col[:-len(suffix)])
+
+def trend_stats(values, mask_zeros=False):
+    # Наклон МНК по номеру дня и разница средних второй и первой половины
+    # периода для всех строк сразу: матричные операции над массивом строки × дни
+    y = np.array(values, dtype=np.float64)
+    if mask_zeros:
+        y[y == 0] = np.nan
+    present = ~np.isnan(y)
+    filled = np.where(present, y, 0.0)
+    days = np.arange(y.shape[1], dtype=np.float64)
+
+    n = present.sum(axis=1)
+    sum_x = present @ days
+    sum_xx = present @ (days * days)
+    sum_y = filled.sum(axis=1)
+    sum_xy = filled @ days
+    denominator = n * sum_xx - sum_x * sum_x
+
+    half = y.shape[1] // 2
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        slope = np.where(denominator > 0, (n * sum_xy - sum_x * sum_y) / denominator, np.nan)
+        if half:
+            delta = np.nanmean(y[:, y.shape[1] - half:], axis=1) - np.nanmean(y[:, :half], axis=1)
+        else:
+            delta = np.full(len(y), np.nan)
+    return np.nan_to_num(slope), np.nan_to_num(delta)
+
+TREND_SUFFIXES = (
+    ('позиции', '_position', True),
+    ('показов', '_shows', False),
+    ('кликов', '_clicks', False),
+)
+
+def add_trend_columns(df, arrays=None):
+    if arrays is None:
+        arrays = daily_arrays(df, [suffix for _, suffix, _ in TREND_SUFFIXES])
+    for label, suffix, mask_zeros in TREND_SUFFIXES:
+        slope, delta = trend_stats(arrays[suffix], mask_zeros)
+        df[f'Тренд {label}'] = np.round(slope, 2)
+        df[f'Δ {label}'] = np.round(delta, 1)
+    return df
+
+def add_word_count_column(df, tokens=None):
+    if tokens is None:
+        tokens = tokenize_queries(df['Query'])
+    df['Кол-во слов'] = pd.Series(tokens.lengths, index=tokens.index).reindex(df.index)
+    return df
+
+def create_output_file_name(input_file, domain, mode, with_source=False, output_format='xlsx'):
     current_date = datetime.now().strftime('%Y-%m-%d')
+    # В пакетном режиме к имени добавляется имя выгрузки, чтобы результаты
+    # нескольких файлов одного сайта не перезаписывали друг друга
+    suffix = f"-{os.path.splitext(os.path.basename(input_file))[0]}" if with_source else ''
     if mode == 1:
-        return f"{domain}-semantics-{current_date}.xlsx"
+        return f"{domain}-semantics-{current_date}{suffix}.{output_format}"
     elif mode == 2:
-        return f"{domain}-pages-{current_date}.xlsx"
+        return f"{domain}-pages-{current_date}{suffix}.{output_format}"
     else:
         raise ValueError("Неверный режим анализа. Допустимые значения: 1 или 2.")
 
-def create_word_count_df(df):
-    word_count = {}
-    for query in df['Query']:
-        words = str(query).split()
-        for word in words:
-            if word in word_count:
-                word_count[word] += 1
-            else:
-                word_count[word] = 1
-    word_count_df = pd.DataFrame(word_count.items(), columns=['Слово', 'Количество'])
+def create_word_count_df(df, tokens=None):
+    if tokens is None:
+        tokens = tokenize_queries(df['Query'])
+        codes = tokens.codes
+    else:
+        codes = tokens.codes[select_tokens(tokens, df.index)]
+    counts = np.bincount(codes, minlength=len(tokens.vocabulary))
+    found = counts > 0
+    word_count_df = pd.DataFrame({'Слово': tokens.vocabulary[found], 'Количество': counts[found]})
     return word_count_df
 
+def ngram_keys(tokens, n):
+    # Номера первых слов всех n-грамм, не пересекающих границу запроса, и их
+    # ключи: коды слов, сложенные в одно число. Если произведение размеров
+    # словаря не помещается в int64, ключ — хэш с перемешиванием
+    codes = tokens.codes.astype(np.int64)
+    if len(codes) < n:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    starts = np.flatnonzero(tokens.rows[n - 1:] == tokens.rows[:len(codes) - n + 1])
+    size = max(len(tokens.vocabulary), 1)
+    if size ** n < 2 ** 63:
+        keys = codes[starts]
+        for offset in range(1, n):
+            keys = keys * size + codes[starts + offset]
+    else:
+        keys = codes[starts].astype(np.uint64)
+        with np.errstate(over='ignore'):
+            for offset in range(1, n):
+                keys = keys * np.uint64(0x9E3779B97F4A7C15) ^ codes[starts + offset].astype(np.uint64)
+    return starts, keys
+
+def count_ngrams(df, tokens, n, min_support=NGRAM_MIN_SUPPORT):
+    # Для каждой n-граммы: в скольких запросах она встречается и суммарные
+    # частотность и клики этих запросов. Подсчет идет по хэш-таблице factorize
+    # и bincount, без промежуточных строк для каждой n-граммы. Вместе со
+    # счетчиками возвращается номер первого слова одного из вхождений
+    starts, keys = ngram_keys(tokens, n)
+    positions = tokens.index.get_indexer(df.index)
+    selected = np.zeros(len(tokens.lengths), dtype=bool)
+    selected[positions] = True
+    rows = tokens.rows[starts]
+    keep = selected[rows]
+    starts, keys, rows = starts[keep], keys[keep], rows[keep]
+
+    key_codes, uniques = pd.factorize(keys)
+    # Повтор n-граммы в одном запросе считается один раз
+    _, first_in_row = np.unique(rows * max(len(uniques), 1) + key_codes, return_index=True)
+    starts, key_codes, rows = starts[first_in_row], key_codes[first_in_row], rows[first_in_row]
+
+    counts = np.bincount(key_codes, minlength=len(uniques))
+    frequent = np.flatnonzero(counts >= min_support)
+    first = np.empty(len(uniques), dtype=np.int64)
+    first[key_codes[::-1]] = starts[::-1]
+
+    counts_df = pd.DataFrame({'Количество': counts[frequent]})
+    for name, column in (('Сум. частотность', 'Сум. частотность за 14 дн'), ('Сум. кликов', 'Сум. кликов за 14 дн.')):
+        weights = np.zeros(len(tokens.lengths))
+        weights[positions] = df[column].to_numpy(dtype=np.float64)
+        sums = np.bincount(key_codes, weights=weights[rows], minlength=len(uniques))[frequent]
+        counts_df[name] = sums.astype(np.int64) if pd.api.types.is_integer_dtype(df[column]) else sums
+    return first[frequent], counts_df
+
+def create_ngram_df(df, tokens, n, min_support=NGRAM_MIN_SUPPORT):
+    first, counts_df = count_ngrams(df, tokens, n, min_support)
+    vocabulary = np.asarray(tokens.vocabulary, dtype=object)
+    phrases = vocabulary[tokens.codes[first]]
+    for offset in range(1, n):
+        phrases = phrases + ' ' + vocabulary[tokens.codes[first + offset]]
+    counts_df.insert(0, 'Фраза', phrases)
+    return counts_df.sort_values(by=['Количество', 'Сум. частотность'], ascending=False, ignore_index=True)
+
+def ngram_chunk_counts(df, tokens, n, word_ids):
+    # Счетчики n-грамм куска с ключами, общими для всех кусков: слова получают
+    # номера в словаре word_ids на весь файл, и номера слов n-граммы
+    # упаковываются в int64 по 63 // n бит. N-граммы со словами, номер которых
+    # в эти биты не помещается (больше 2 млн различных слов для триграмм), не считаются
+    first, counts_df = count_ngrams(df, tokens, n, 1)
+    bits = 63 // n
+    ids = np.fromiter((word_ids.setdefault(word, len(word_ids)) for word in tokens.vocabulary),
+                      dtype=np.int64, count=len(tokens.vocabulary))
+    keys = np.zeros(len(first), dtype=np.int64)
+    fits = np.ones(len(first), dtype=bool)
+    for offset in range(n):
+        word = ids[tokens.codes[first + offset]]
+        fits &= word < 1 << bits
+        keys = (keys << bits) | word
+    counts_df.index = keys
+    return counts_df[fits]
+
+def ngram_phrases(keys, words, n):
+    bits = 63 // n
+    words = np.asarray(words, dtype=object)
+    phrases = None
+    for offset in reversed(range(n)):
+        word = words[(keys >> (bits * offset)) & ((1 << bits) - 1)]
+        phrases = word if phrases is None else phrases + ' ' + word
+    return phrases
+
+def minhash_signatures(rows, features, num_rows, num_features, num_hashes=CLUSTER_HASHES, seed=0):
+    # Каждой хэш-функции соответствует случайное значение для каждого признака,
+    # подпись строки — минимум этих значений по ее признакам. Признаки строки
+    # должны идти подряд (rows отсортирован)
+    rng = np.random.default_rng(seed)
+    values = rng.integers(0, 2 ** 32 - 1, size=(num_hashes, num_features), dtype=np.uint32)
+    signatures = np.full((num_hashes, num_rows), np.iinfo(np.uint32).max, dtype=np.uint32)
+    if len(rows):
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        for i in range(num_hashes):
+            signatures[i, rows[starts]] = np.minimum.reduceat(values[i, features], starts)
+    return signatures
+
+def cluster_queries(df, tokens, threshold=CLUSTER_THRESHOLD, bands=CLUSTER_BANDS):
+    # Запросы сравниваются по множествам слов; посадочный URL добавляется
+    # к множеству как еще один признак. Кандидаты в пары ищутся через LSH:
+    # запросы с одинаковой полосой MinHash попадают в одну корзину, и каждый
+    # запрос сравнивается только с первым и предыдущим запросом корзины
+    num_rows = len(df)
+    positions = np.full(len(tokens.lengths), -1)
+    positions[tokens.index.get_indexer(df.index)] = np.arange(num_rows)
+    token_rows = positions[tokens.rows]
+    keep = token_rows >= 0
+    token_rows, features = token_rows[keep], tokens.codes[keep].astype(np.int64)
+
+    url_codes, urls = pd.factorize(df['Url'].astype(object))
+    has_url = url_codes >= 0
+    rows = np.concatenate([token_rows, np.flatnonzero(has_url)])
+    features = np.concatenate([features, len(tokens.vocabulary) + url_codes[has_url]])
+
+    # Дальше запросы нумеруются по убыванию частотности: лидер кластера —
+    # самый частотный запрос, и первый запрос корзины всегда самый частотный в ней
+    demand = df['Сум. частотность за 14 дн'].to_numpy(dtype=np.float64)
+    by_demand = np.argsort(-demand, kind='stable')
+    rank = np.empty(num_rows, dtype=np.int64)
+    rank[by_demand] = np.arange(num_rows)
+    rows = rank[rows]
+    order = np.argsort(rows, kind='stable')
+    signatures = minhash_signatures(rows[order], features[order], num_rows, len(tokens.vocabulary) + len(urls))
+
+    # Запросы без слов остаются отдельными кластерами
+    candidates = np.unique(rank[token_rows])
+    band_size = len(signatures) // bands
+    members, heads = [], []
+    for band in range(bands):
+        keys = signatures[band * band_size, candidates].astype(np.uint64)
+        with np.errstate(over='ignore'):
+            for i in range(band * band_size + 1, (band + 1) * band_size):
+                keys = keys * np.uint64(0x9E3779B97F4A7C15) ^ signatures[i, candidates].astype(np.uint64)
+        bucket_codes, buckets = pd.factorize(keys)
+        first = np.empty(len(buckets), dtype=np.int64)
+        first[bucket_codes[::-1]] = candidates[::-1]
+        in_bucket = np.lexsort((candidates, bucket_codes))
+        sorted_rows, sorted_codes = candidates[in_bucket], bucket_codes[in_bucket]
+        previous = np.flatnonzero(sorted_codes[1:] == sorted_codes[:-1]) + 1
+        members += [candidates, sorted_rows[previous]]
+        heads += [first[bucket_codes], sorted_rows[previous - 1]]
+    members, heads = np.concatenate(members), np.concatenate(heads)
+    earlier = heads < members
+    pairs = np.unique(members[earlier] * num_rows + heads[earlier])
+    members, heads = pairs // num_rows, pairs % num_rows
+
+    # Запрос присоединяется к самому похожему из уже найденных лидеров, если
+    # сходство не ниже порога, иначе сам становится лидером. Кандидат всегда
+    # заменяется своим лидером, поэтому цепочек «похож на похожего» не возникает
+    leaders = np.arange(num_rows)
+    if not len(members):
+        return leaders[rank]
+    bounds = np.flatnonzero(np.r_[True, members[1:] != members[:-1], True])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        member = members[start]
+        roots = np.unique(leaders[heads[start:end]])
+        similarity = (signatures[:, roots] == signatures[:, member, None]).mean(axis=0)
+        best = similarity.argmax()
+        if similarity[best] >= threshold:
+            leaders[member] = roots[best]
+    return leaders[rank]
+
+def add_cluster_columns(df, labels):
+    # Номера кластеров идут по убыванию суммарной частотности, название —
+    # самый частотный запрос кластера
+    demand = df['Сум. частотность за 14 дн'].to_numpy(dtype=np.float64)
+    label_codes, _ = pd.factorize(labels)
+    totals = np.bincount(label_codes, weights=demand)
+    ranks = np.empty(len(totals), dtype=np.int64)
+    ranks[np.lexsort((np.arange(len(totals)), -totals))] = np.arange(1, len(totals) + 1)
+    order = np.lexsort((-demand, label_codes))
+    leaders = np.empty(len(totals), dtype=np.int64)
+    leaders[label_codes[order][::-1]] = order[::-1]
+
+    df = df.copy()
+    df['Кластер'] = ranks[label_codes]
+    df['Название кластера'] = df['Query'].astype(object).to_numpy()[leaders][label_codes]
+    return df
+
+def mean_position(df, by, sort):
+    # Нулевая позиция означает, что позиции нет, поэтому в среднее не входит
+    positions = df['Ср. позиция'].where(df['Ср. позиция'] > 0)
+    return positions.groupby(df[by], sort=sort).mean().round(1).fillna(0)
+
+def create_cluster_df(df):
+    cluster_df = df.groupby('Кластер', sort=True).agg(**{
+        'Название кластера': ('Название кластера', 'first'),
+        'Запросов': ('Query', 'size'),
+        'Сум. частотность за 14 дн': ('Сум. частотность за 14 дн', 'sum'),
+        'Сум. кликов за 14 дн.': ('Сум. кликов за 14 дн.', 'sum'),
+    })
+    cluster_df['Ср. позиция'] = mean_position(df, 'Кластер', sort=True)
+    # Основной URL — посадочная страница с наибольшей частотностью в кластере
+    url_demand = df.groupby(['Кластер', df['Url'].astype(object)], sort=False)['Сум. частотность за 14 дн'].sum()
+    main_urls = url_demand.sort_values(ascending=False, kind='stable').reset_index().drop_duplicates('Кластер')
+    cluster_df['Основной URL'] = main_urls.set_index('Кластер')['Url'].reindex(cluster_df.index)
+    return cluster_df.reset_index()
+
+def within_one_edit(a, b):
+    # Расстояние Дамерау — Левенштейна не больше 1: вставка, удаление,
+    # замена или перестановка соседних букв
+    if abs(len(a) - len(b)) > 1:
+        return False
+    start = 0
+    while start < min(len(a), len(b)) and a[start] == b[start]:
+        start += 1
+    if len(a) != len(b):
+        longer, shorter = (a, b) if len(a) > len(b) else (b, a)
+        return longer[start + 1:] == shorter[start:]
+    return (a[start + 1:] == b[start + 1:]
+            or a[start + 2:] == b[start + 2:] and a[start:start + 2] == b[start:start + 2][::-1])
+
+def canonical_words(words, weights):
+    # Индекс удалений SymSpell: каждое слово записывается под всеми своими
+    # вариантами без одной буквы, и слова с общим вариантом — кандидаты в
+    # опечатки друг друга. Так сравниваются только кандидаты, а не все пары.
+    # Слова обходятся по убыванию частоты, и опечатка заменяется самым
+    # частым похожим словом, которое само не заменено
+    order = sorted(range(len(words)), key=lambda i: (-weights[i], words[i]))
+    canonical = list(words)
+    index = {}
+    for i in order:
+        word = words[i]
+        if len(word) < DEDUP_MIN_WORD or not word.isalpha():
+            continue
+        keys = {word} | {word[:j] + word[j + 1:] for j in range(len(word))}
+        candidates = {k for key in keys for k in index.get(key, ())}
+        for k in sorted(candidates, key=lambda k: (-weights[k], words[k])):
+            if within_one_edit(word, words[k]):
+                canonical[i] = words[k]
+                break
+        else:
+            for key in keys:
+                index.setdefault(key, []).append(i)
+    return canonical
+
+def find_duplicates(df, tokens):
+    # Ключ запроса — его слова, исправленные по canonical_words и
+    # отсортированные, поэтому «диван купить» и «купить дивна» получают
+    # один ключ с «купить диван». Ключи считаются по уникальным запросам
+    cleaned = clean_vocabulary(tokens.vocabulary)
+    clean_codes, clean_words = pd.factorize(cleaned.to_numpy())
+    codes = clean_codes[tokens.codes[select_tokens(tokens, df.index)]]
+    weights = np.bincount(codes, minlength=len(clean_words))
+    canonical = dict(zip(tokens.vocabulary, np.array(canonical_words(list(clean_words), weights))[clean_codes]))
+
+    query_codes, queries = pd.factorize(df['Query'].astype(object))
+    # Запросы без слов (только знаки препинания) и пустые запросы дублями не
+    # считаются: их ключ — сам запрос с пробелом впереди, а ключи из слов
+    # с пробела не начинаются
+    keys = [' '.join(sorted(canonical[word] for word in str(query).split() if canonical[word])) or f' {query}'
+            for query in queries]
+    key_codes, _ = pd.factorize(np.array(keys + [' '], dtype=object))
+    return key_codes[query_codes]
+
+def add_duplicate_columns(df, labels):
+    # Группа — запросы с одинаковым ключом, если среди них есть хотя бы два
+    # разных запроса. Основной вариант — самый частотный запрос группы
+    demand = df['Сум. частотность за 14 дн'].to_numpy(dtype=np.float64)
+    queries = df['Query'].astype(object).to_numpy()
+    query_codes, _ = pd.factorize(queries)
+    num_groups = int(labels.max()) + 1 if len(labels) else 0
+    distinct = pd.Series(query_codes).groupby(labels).nunique().reindex(range(num_groups), fill_value=0)
+    in_group = distinct.to_numpy()[labels] > 1
+
+    order = np.lexsort((-demand, labels))
+    leaders = np.empty(num_groups, dtype=np.int64)
+    leaders[labels[order][::-1]] = order[::-1]
+    df = df.copy()
+    df['Основной вариант'] = np.where(in_group, queries[leaders][labels], '')
+    return df
+
+def create_duplicate_df(df):
+    duplicates = df[df['Основной вариант'] != '']
+    duplicate_df = duplicates.groupby('Основной вариант', sort=False).agg(**{
+        'Запросов': ('Query', 'nunique'),
+        'Сум. частотность за 14 дн': ('Сум. частотность за 14 дн', 'sum'),
+        'Сум. кликов за 14 дн.': ('Сум. кликов за 14 дн.', 'sum'),
+    })
+    duplicate_df['Ср. позиция'] = mean_position(duplicates, 'Основной вариант', sort=False)
+    variants = duplicates[duplicates['Query'].astype(object) != duplicates['Основной вариант']]
+    duplicate_df['Варианты'] = (variants['Query'].astype(object).groupby(variants['Основной вариант'], sort=False)
+                                .agg(lambda queries: ', '.join(dict.fromkeys(queries))))
+    duplicate_df = duplicate_df.sort_values('Сум. частотность за 14 дн', ascending=False, kind='stable')
+    return duplicate_df.reset_index()[['Основной вариант', 'Варианты', 'Запросов', 'Сум. частотность за 14 дн',
+                                       'Сум. кликов за 14 дн.', 'Ср. позиция']]
+
+def cannibalization_pairs(df):
+    # Суммы по парам (запрос, URL) для листа «Каннибализация». Позиция хранится
+    # умноженной на показы, поэтому суммы разных кусков можно просто сложить
+    df = df[df['Сум. показов за 14 дн'] > 0]
+    pairs = pd.DataFrame({
+        'Query': df['Query'].astype(object),
+        'Url': df['Url'].astype(object),
+        'shows': df['Сум. показов за 14 дн'].astype(np.float64),
+        'clicks': df['Сум. кликов за 14 дн.'].astype(np.float64),
+        'position': df['Ср. позиция'].astype(np.float64) * df['Сум. показов за 14 дн'],
+    })
+    return sum_by_pair(pairs)
+
+def sum_by_pair(pairs):
+    return pairs.groupby(['Query', 'Url'], sort=False).sum().reset_index()
+
+def create_cannibalization_df(pairs):
+    # Запросы, по которым показывались несколько страниц сайта. Доли считаются
+    # от показов и кликов запроса, позиция страницы — средняя, взвешенная по показам
+    pairs = pairs[pairs.groupby('Query', sort=False)['Url'].transform('size') > 1]
+
+    by_query = pairs.groupby('Query', sort=False)
+    query_shows = by_query['shows'].transform('sum')
+    query_clicks = by_query['clicks'].transform('sum')
+    cannibalization_df = pd.DataFrame({
+        'Query': pairs['Query'],
+        'Url': pairs['Url'],
+        'Страниц': by_query['Url'].transform('size'),
+        'Сум. показов за 14 дн': pairs['shows'].astype(np.int64),
+        'Доля показов, %': np.round(pairs['shows'] / query_shows * 100, 1),
+        'Сум. кликов за 14 дн.': pairs['clicks'].astype(np.int64),
+        'Доля кликов, %': np.round(pairs['clicks'] / query_clicks.where(query_clicks > 0) * 100, 1).fillna(0),
+        'Ср. позиция': np.round(pairs['position'] / pairs['shows'], 1),
+    })
+    # Сначала запросы с наибольшими показами, внутри запроса — страницы по убыванию показов
+    query_order, _ = pd.factorize(pairs['Query'], sort=True)
+    order = np.lexsort((-pairs['shows'].to_numpy(), query_order, -query_shows.to_numpy()))
+    return cannibalization_df.iloc[order].reset_index(drop=True)
+
 def process_pages_data(df, site_url):
-    shows_columns = [col for col in df.columns if col.endswith('_shows')]
-    position_columns = [col for col in df.columns if col.endswith('_position')]
-    clicks_columns = [col for col in df.columns if col.endswith('_clicks')]
-    ctr_columns = [col for col in df.columns if col.endswith('_ctr')]
-
-    df['Сум. показов за 14 дн'] = df[shows_columns].sum(axis=1)
-    df['Ср. позиция'] = df[position_columns].apply(lambda x: x.replace(0, pd.NA).mean(), axis=1).round(1).fillna(0)
-    df['Ср. дн. показов'] = df[shows_columns].mean(axis=1).round(0)
-    df['Ср. число кликов'] = df[clicks_columns].mean(axis=1).round(0)
-    df['Сум. кликов за 14 дн.'] = df[clicks_columns].sum(axis=1)
-    df['Ср. CTR'] = df[ctr_columns].mean(axis=1).round(1)
-    
-    df['Полный URL'] = site_url + df['Url']
+    arrays = daily_arrays(df, MODE_SUFFIXES[2])
+    df = add_metric_columns(df, REPORT_METRICS[2], arrays)
+    df = add_trend_columns(df, arrays)
+
+    df['Полный URL'] = full_url_column(df['Url'], site_url)
 
     result_df = df[[
         'Полный URL', 
@@ -114,114 +1651,1031 @@ def process_pages_data(df, site_url):
         'Сум. показов за 14 дн',
         'Ср. число кликов',
         'Сум. кликов за 14 дн.',
-        'Ср. CTR'
+        'Ср. CTR',
+        *TREND_COLUMNS
     ]]
 
     return result_df
 
+def page_summary_rows(result_df, df):
+    # Слагаемые сводки по страницам для каждой строки отчета. Суммы показов и
+    # кликов берутся из отчета, а дневные показы и позиции — из исходной
+    # выгрузки для тех же строк. Позиция взвешивается показами за тот же
+    # день, дни без позиции не учитываются
+    rows = df.index.get_indexer(result_df.index)
+    shows = df[daily_columns(df, '_shows')].to_numpy(dtype=np.float64)[rows]
+    positions = df[daily_columns(df, '_position')].to_numpy(dtype=np.float64)[rows]
+    ranked_shows = np.where(positions > 0, shows, 0.0)
+    return pd.DataFrame({
+        'Url': result_df['Url'].astype(object),
+        'queries': 1,
+        'shows': result_df['Сум. показов за 14 дн'].to_numpy(dtype=np.float64),
+        'clicks': result_df['Сум. кликов за 14 дн.'].to_numpy(dtype=np.float64),
+        'position': (positions * ranked_shows).sum(axis=1),
+        'ranked_shows': ranked_shows.sum(axis=1),
+    }, index=result_df.index)
+
+def sum_by_url(rows):
+    return rows.groupby('Url', sort=False).sum().reset_index()
+
+def append_sums(parts, part, combine, min_rows):
+    # Суммы по кускам сворачиваются функцией combine, когда их объем вдвое
+    # превышает уже свернутые, так что в памяти примерно по строке на ключ
+    # независимо от числа кусков
+    parts.append(part)
+    if sum(len(part) for part in parts) > max(2 * len(parts[0]), min_rows):
+        parts[:] = [combine(pd.concat(parts, ignore_index=True))]
+
+def create_page_summary_df(rows, site_url):
+    # Строки или уже сложенные по кускам суммы сворачиваются в одну строку на
+    # страницу. CTR — отношение суммы кликов к сумме показов, а не среднее
+    # дневных CTR
+    sums = sum_by_url(rows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = sums['position'] / sums['ranked_shows']
+        ctr = sums['clicks'] / sums['shows'] * 100
+    summary_df = pd.DataFrame({
+        'Полный URL': full_url_column(sums['Url'], site_url),
+        'Url': sums['Url'],
+        'Запросов': sums['queries'],
+        'Сум. показов за 14 дн': sums['shows'].astype(np.int64),
+        'Сум. кликов за 14 дн.': sums['clicks'].astype(np.int64),
+        'Ср. позиция': round_position(position.to_numpy(), sums.index),
+        'CTR': np.round(ctr, 2).fillna(0),
+    })
+    return summary_df.sort_values('Сум. показов за 14 дн', ascending=False, kind='stable', ignore_index=True)
+
+def url_prefix_regex(prefixes):
+    # Префиксы собираются в префиксное дерево и превращаются в одно регулярное
+    # выражение без перебора альтернатив: на каждом символе остаётся не больше
+    # одной подходящей ветки, поэтому скорость не зависит от числа префиксов
+    trie = {}
+    for prefix in sorted(set(prefixes)):
+        node = trie
+        for char in prefix:
+            if '' in node:
+                break
+            node = node.setdefault(char, {})
+        else:
+            node.clear()
+            node[''] = {}
+
+    def to_regex(node):
+        parts = []
+        for char, child in sorted(node.items()):
+            if char == '':
+                return ''
+            literal = char
+            while len(child) == 1 and '' not in child:
+                (char, child), = child.items()
+                literal += char
+            parts.append(re.escape(literal) + to_regex(child))
+        return parts[0] if len(parts) == 1 else '(?:' + '|'.join(parts) + ')'
+
+    return to_regex(trie) if trie else None
+
+def compile_url_patterns(patterns, site_url):
+    # Строки urls.txt: точный URL, префикс с * на конце (https://site.ru/catalog/*)
+    # или маска с * в середине. Подстановочный знак только *: ? и [ часто
+    # встречаются в точных адресах с параметрами (https://site.ru/page?id=1).
+    # Пути, начинающиеся с /, дополняются адресом сайта
+    exact = set()
+    prefixes = []
+    masks = []
+    for pattern in patterns:
+        if pattern.startswith('/'):
+            pattern = site_url + pattern
+        if '*' not in pattern:
+            exact.add(pattern)
+        elif pattern.endswith('*') and '*' not in pattern[:-1]:
+            prefixes.append(pattern[:-1])
+        else:
+            masks.append('.*'.join(map(re.escape, pattern.split('*'))) + r'\Z')
+
+    parts = []
+    prefix_regex = url_prefix_regex(prefixes)
+    if prefix_regex:
+        parts.append(prefix_regex)
+    parts.extend(masks)
+    regex = re.compile('|'.join(f'(?:{part})' for part in parts)) if parts else None
+    return exact, regex
+
+def match_urls(urls, exact, regex, site_url):
+    # Сопоставление идёт по уникальным адресам, а результат раскладывается
+    # обратно по строкам через коды factorize
+    if isinstance(urls.dtype, pd.CategoricalDtype):
+        codes, uniques = urls.cat.codes.to_numpy(), urls.cat.categories
+    else:
+        codes, uniques = pd.factorize(urls)
+    full_urls = pd.Series(site_url + pd.Index(uniques).astype(str), dtype=object)
+    matched = full_urls.isin(exact).to_numpy()
+    if regex is not None:
+        matched = matched | full_urls.str.match(regex).fillna(False).to_numpy(dtype=bool)
+    return np.append(matched, False)[codes]
+
 def filter_by_urls(df, urls_set, site_url):
     if urls_set is None:
         return df
-    
-    # Создаем множество URL-адресов из DataFrame для сравнения
-    df_urls = {site_url + url for url in df['Url']}
-    urls_intersection = df_urls.intersection(urls_set)
-    
-    if not urls_intersection:
+
+    exact, regex = compile_url_patterns(urls_set, site_url)
+    mask = match_urls(df['Url'], exact, regex, site_url)
+
+    if not mask.any():
         print("\nВНИМАНИЕ: Ни один URL из файла urls.txt не найден в данных!")
         return df
-    
+
     # Фильтруем DataFrame
-    filtered_df = df[df['Полный URL'].isin(urls_intersection)]
+    filtered_df = df[mask]
     print(f"\nОтфильтровано записей: {len(filtered_df)} из {len(df)}")
     return filtered_df
 
-def main():
-    input_file = select_file()
-    if input_file is None:
-        return
-        
-    df = load_data(input_file)
-    if df is None:
-        return
-        
-    mode = determine_report_type(df)
-    if mode is None:
-        print("Не удалось определить тип отчета. Проверьте структуру файла.")
-        input("\nНажмите Enter для завершения...")
+def process_queries_data(df, site_url, tokens=None, dictionaries=None):
+    if tokens is None:
+        tokens = tokenize_queries(df['Query'])
+    df = add_word_count_column(df, tokens)
+    df = add_intent_columns(df, tokens, dictionaries)
+
+    arrays = daily_arrays(df, MODE_SUFFIXES[1])
+    df = add_metric_columns(df, REPORT_METRICS[1], arrays)
+    df = add_trend_columns(df, arrays)
+
+    df['Полный URL'] = full_url_column(df['Url'], site_url)
+
+    min_total_frequency = 0
+    # Устойчивая сортировка: запросы с равной частотностью идут в порядке
+    # выгрузки, как и при слиянии кусков в process_file_chunked
+    result_df = df.loc[df['Сум. частотность за 14 дн'] >= min_total_frequency].sort_values(
+        by='Сум. частотность за 14 дн', ascending=False, kind='stable')
+    result_df = result_df[[
+        'Query',
+        'Url',
+        'Полный URL',
+        'Кол-во слов',
+        'Ср. позиция',
+        'Медианная позиция',
+        'Ср. дн. частотность',
+        'Сум. частотность за 14 дн',
+        'Сум. показов за 14 дн',
+        'Ср. число кликов',
+        'Сум. кликов за 14 дн.',
+        'Охват',
+        'Бренд',
+        'Интент',
+        *TREND_COLUMNS
+    ]]
+
+    return result_df
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В macOS ru_maxrss в байтах, в Linux — в килобайтах
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+@contextmanager
+def stage(timings, name):
+    # Замер этапа: время по часам и процессорное, пиковый RSS процесса и,
+    # если включен tracemalloc, пик памяти, выделенной внутри этапа
+    if timings is None:
+        yield
         return
-        
-    site_url = input("\nПожалуйста, введите адрес сайта в формате https://site.ru: ")
-    domain = site_url.split('//')[-1].split('/')[0]
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        timings.append({
+            'stage': name,
+            'wall': time.perf_counter() - wall,
+            'cpu': time.process_time() - cpu,
+            'rss_mb': peak_rss_mb(),
+            'traced_mb': round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1) if tracemalloc.is_tracing() else None,
+        })
 
-    # Загружаем URLs из файла
-    urls_set = load_urls_from_file()
+def summarize_stages(timings):
+    # Повторы одного этапа (куски при --chunk-size) складываются, память берется по максимуму
+    summary = {}
+    for timing in timings:
+        total = summary.setdefault(timing['stage'], dict(timing, calls=0, wall=0.0, cpu=0.0))
+        total['calls'] += 1
+        total['wall'] += timing['wall']
+        total['cpu'] += timing['cpu']
+        for key in ('rss_mb', 'traced_mb'):
+            if timing[key] is not None:
+                total[key] = max(total[key] or 0, timing[key])
+    return [dict(total, wall=round(total['wall'], 4), cpu=round(total['cpu'], 4)) for total in summary.values()]
+
+def print_stages(stages):
+    print(f"\n{'Этап':<10} {'Время, с':>9} {'CPU, с':>9} {'Пик RSS, МБ':>12} {'tracemalloc, МБ':>16}")
+    for item in stages:
+        rss = '—' if item['rss_mb'] is None else item['rss_mb']
+        traced = '—' if item['traced_mb'] is None else item['traced_mb']
+        print(f"{item['stage']:<10} {item['wall']:>9.3f} {item['cpu']:>9.3f} {rss:>12} {traced:>16}")
+
+def save_profile(profiler, profile_path, limit=20):
+    # Полный профиль сохраняется для pstats/snakeviz, а в отчет попадают
+    # limit самых дорогих функций по суммарному времени
+    profiler.dump_stats(profile_path)
+    stream = io.StringIO()
+    pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
 
+def append_run_log(log_path, result, options):
+    # Журнал запусков в формате JSON Lines: одна запись на обработанный файл
+    record = {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'file': result['file'],
+        'input_bytes': os.path.getsize(result['file']) if os.path.exists(result['file']) else None,
+        'output': result['output'],
+        'mode': result['mode'],
+        'rows': result['rows'],
+        'error': result['error'],
+        'seconds': round(result['seconds'], 4),
+        'cpu_seconds': round(result['cpu_seconds'], 4),
+        'stages': result['stages'],
+        'format': options['output_format'],
+        'chunk_rows': options['chunk_rows'],
+        'python': sys.version.split()[0],
+        'pandas': pd.__version__,
+    }
+    with open(log_path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def build_report(df, mode, site_url, urls_set=None, timings=None, ngram_min_support=NGRAM_MIN_SUPPORT,
+                 cluster_threshold=None, normalize_words=True, dictionaries=None, dedup=False):
     if mode == 1:
         print("\nОбнаружен отчет по поисковым запросам. Обработка...")
-        df = add_word_count_column(df)
-        
-        demand_columns = [col for col in df.columns if col.endswith('_demand')]
-        shows_columns = [col for col in df.columns if col.endswith('_shows')]
-        position_columns = [col for col in df.columns if col.endswith('_position')]
-        clicks_columns = [col for col in df.columns if col.endswith('_clicks')]
-
-        df['Сум. частотность за 14 дн'] = df[demand_columns].sum(axis=1)
-        df['Ср. позиция'] = df[position_columns].apply(lambda x: x.replace(0, pd.NA).mean(), axis=1).round(1).fillna(0)
-        df['Медианная позиция'] = df[position_columns].apply(lambda x: x.replace(0, pd.NA).median(), axis=1).round(1).fillna(0)
-        df['Охват'] = round((df[shows_columns].sum(axis=1) / df[demand_columns].sum(axis=1)) * 100, 1)
-        df['Ср. дн. частотность'] = df[demand_columns].mean(axis=1).round(0)
-        df['Ср. число кликов'] = df[clicks_columns].mean(axis=1).round(0)
-        df['Сум. кликов за 14 дн.'] = df[clicks_columns].sum(axis=1)
-        
-        df['Полный URL'] = site_url + df['Url']
-
-        min_total_frequency = 0
-        result_df = df.loc[df['Сум. частотность за 14 дн'] >= min_total_frequency].sort_values(by='Сум. частотность за 14 дн', ascending=False)
-        result_df = result_df[[
-            'Query',
-            'Url',
-            'Полный URL',
-            'Кол-во слов',
-            'Ср. позиция',
-            'Медианная позиция',
-            'Ср. дн. частотность',
-            'Сум. частотность за 14 дн',
-            'Ср. число кликов',
-            'Сум. кликов за 14 дн.',
-            'Охват'
-        ]]
-        
+        with stage(timings, 'metrics'):
+            tokens = tokenize_queries(df['Query'])
+            result_df = process_queries_data(df, site_url, tokens, dictionaries)
+
         if urls_set:
-            result_df = filter_by_urls(result_df, urls_set, site_url)
-        
-        word_count_df = create_word_count_df(result_df)
-        word_count_df = word_count_df.sort_values(by='Количество', ascending=False)
+            with stage(timings, 'filter'):
+                result_df = filter_by_urls(result_df, urls_set, site_url)
+
+        with stage(timings, 'words'):
+            word_count_df = create_word_count_df(result_df, tokens)
+            if normalize_words:
+                word_count_df = normalize_word_counts(word_count_df)
+            word_count_df = sort_word_counts(word_count_df)
+        sheets = {'Семантическое ядро': result_df, 'Статистика слов': word_count_df}
+
+        if ngram_min_support is not None:
+            with stage(timings, 'ngrams'):
+                for n, sheet_name in NGRAM_SHEETS.items():
+                    sheets[sheet_name] = create_ngram_df(result_df, tokens, n, ngram_min_support)
+
+        with stage(timings, 'cannibalization'):
+            sheets['Каннибализация'] = create_cannibalization_df(cannibalization_pairs(result_df))
+
+        if cluster_threshold is not None:
+            with stage(timings, 'clusters'):
+                labels = cluster_queries(result_df, tokens, cluster_threshold)
+                sheets['Семантическое ядро'] = add_cluster_columns(result_df, labels)
+                sheets['Кластеры'] = create_cluster_df(sheets['Семантическое ядро'])
+
+        if dedup:
+            with stage(timings, 'dedup'):
+                labels = find_duplicates(result_df, tokens)
+                sheets['Семантическое ядро'] = add_duplicate_columns(sheets['Семантическое ядро'], labels)
+                sheets['Дубли'] = create_duplicate_df(sheets['Семантическое ядро'])
+        return sheets
 
     elif mode == 2:
         print("\nОбнаружен отчет по страницам. Обработка...")
-        result_df = process_pages_data(df, site_url)
-        
+        with stage(timings, 'metrics'):
+            result_df = process_pages_data(df, site_url)
+
         if urls_set:
-            result_df = filter_by_urls(result_df, urls_set, site_url)
+            with stage(timings, 'filter'):
+                result_df = filter_by_urls(result_df, urls_set, site_url)
 
-    output_file_name = create_output_file_name(input_file, domain, mode)
+        with stage(timings, 'page_summary'):
+            summary_df = create_page_summary_df(page_summary_rows(result_df, df), site_url)
+        with stage(timings, 'cannibalization'):
+            cannibalization_df = create_cannibalization_df(cannibalization_pairs(result_df))
+        return {'Страницы': result_df, 'Сводка по страницам': summary_df, 'Каннибализация': cannibalization_df}
 
-    with pd.ExcelWriter(output_file_name, engine='openpyxl') as writer:
-        sheet_name = 'Семантическое ядро' if mode == 1 else 'Страницы'
-        result_df.to_excel(writer, index=False, sheet_name=sheet_name)
-        
-        for column in writer.sheets[sheet_name].columns:
-            max_length = max(len(str(cell.value)) for cell in column)
-            writer.sheets[sheet_name].column_dimensions[column[0].column_letter].width = min(max_length + 2, 50)
+    raise ValueError("Неверный режим анализа. Допустимые значения: 1 или 2.")
+
+def column_widths(df, sample_rows=10000, max_width=50):
+    # Ширина считается по данным DataFrame, а не по ячейкам уже записанного листа.
+    # Длина записи числа зависит от его величины и дробной части, поэтому для
+    # больших числовых колонок достаточно выборки и крайних значений
+    widths = []
+    for name in df.columns:
+        column = df[name]
+        if len(column) > sample_rows and pd.api.types.is_numeric_dtype(column):
+            column = pd.concat([column.sample(sample_rows, random_state=0), column.agg(['min', 'max'])])
+        length = column.astype(str).str.len().max() if len(column) else 0
+        widths.append(min(max(len(str(name)), int(length)) + 2, max_width))
+    return widths
+
+def iter_sheet_rows(df, chunk_rows=10000):
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].astype(object)
+        yield from chunk.where(chunk.notna(), None).itertuples(index=False, name=None)
+
+def dataset_name(sheet_name):
+    return DATASET_NAMES.get(sheet_name) or re.sub(r'\W+', '_', sheet_name.lower()).strip('_')
+
+def dataset_file_name(output_file_name, sheet_name):
+    stem, ext = os.path.splitext(output_file_name)
+    return f"{stem}-{dataset_name(sheet_name)}{ext}"
+
+def output_format_from_name(output_file_name):
+    ext = os.path.splitext(output_file_name)[1].lower().lstrip('.')
+    return OUTPUT_EXTENSIONS.get(ext)
+
+def write_report(output_file_name, sheets, output_format='xlsx'):
+    # Возвращает список записанных файлов: форматы без листов (csv, jsonl,
+    # parquet) пишут каждый набор данных в отдельный файл. Лист может быть
+    # DataFrame или итератором кусков DataFrame, если отчет не помещается в память
+    return OUTPUT_WRITERS[output_format](output_file_name, sheets)
+
+def sheet_chunks(sheet):
+    return [sheet] if isinstance(sheet, pd.DataFrame) else sheet
+
+def write_csv_report(output_file_name, sheets, chunk_rows=100000):
+    written = []
+    for sheet_name, sheet in sheets.items():
+        file_name = dataset_file_name(output_file_name, sheet_name)
+        for i, sheet_df in enumerate(sheet_chunks(sheet)):
+            sheet_df.to_csv(file_name, mode='a' if i else 'w', header=not i, index=False, encoding='utf-8',
+                            chunksize=chunk_rows)
+        written.append(file_name)
+    return written
+
+def write_jsonl_report(output_file_name, sheets, chunk_rows=100000):
+    written = []
+    for sheet_name, sheet in sheets.items():
+        file_name = dataset_file_name(output_file_name, sheet_name)
+        with open(file_name, 'w', encoding='utf-8') as file:
+            for sheet_df in sheet_chunks(sheet):
+                for start in range(0, len(sheet_df), chunk_rows):
+                    chunk = sheet_df.iloc[start:start + chunk_rows]
+                    lines = chunk.to_json(orient='records', lines=True, force_ascii=False)
+                    file.write(lines if lines.endswith('\n') else lines + '\n')
+        written.append(file_name)
+    return written
+
+def write_parquet_report(output_file_name, sheets):
+    if pyarrow is None:
+        raise RuntimeError('для записи в Parquet нужна библиотека pyarrow (pip install pyarrow)')
+    written = []
+    for sheet_name, sheet in sheets.items():
+        file_name = dataset_file_name(output_file_name, sheet_name)
+        if isinstance(sheet, pd.DataFrame):
+            sheet.to_parquet(file_name, index=False)
+        else:
+            # Куски пишутся отдельными группами строк одного файла со схемой первого куска
+            writer = None
+            try:
+                for sheet_df in sheet:
+                    table = pyarrow.Table.from_pandas(sheet_df, preserve_index=False)
+                    if writer is None:
+                        writer = pyarrow.parquet.ParquetWriter(file_name, table.schema)
+                    writer.write_table(table.cast(writer.schema))
+            finally:
+                if writer is not None:
+                    writer.close()
+        written.append(file_name)
+    return written
+
+def write_sqlite_report(output_file_name, sheets, chunk_rows=10000):
+    # Все наборы данных — таблицы одной базы; повторный запуск заменяет их
+    with closing(sqlite3.connect(output_file_name)) as connection, connection:
+        for sheet_name, sheet in sheets.items():
+            for i, sheet_df in enumerate(sheet_chunks(sheet)):
+                sheet_df.to_sql(dataset_name(sheet_name), connection, if_exists='append' if i else 'replace',
+                                index=False, chunksize=chunk_rows)
+    return [output_file_name]
+
+def write_xlsx_report(output_file_name, sheets):
+    for sheet_name, sheet in sheets.items():
+        if isinstance(sheet, pd.DataFrame) and len(sheet) >= EXCEL_MAX_ROWS:
+            raise ValueError(f"Лист «{sheet_name}» содержит {len(sheet)} строк, больше предела Excel ({EXCEL_MAX_ROWS - 1})")
+
+    try:
+        if xlsxwriter is not None:
+            write_xlsx_xlsxwriter(output_file_name, sheets)
+        else:
+            write_xlsx_openpyxl(output_file_name, sheets)
+    except ValueError:
+        # Предел строк для потоковых листов выясняется только во время записи
+        if os.path.exists(output_file_name):
+            os.remove(output_file_name)
+        raise
+    return [output_file_name]
+
+def sheet_layout(sheet_name, sheet):
+    # Ширина колонок считается по первому куску листа
+    chunks = iter(sheet_chunks(sheet))
+    first = next(chunks)
+    widths = [25] * len(first.columns) if sheet_name == 'Статистика слов' else column_widths(first)
+    return first.columns, widths, chain([first], chunks)
+
+def iter_xlsx_sheet_rows(sheet_name, chunks):
+    row_number = 0
+    for sheet_df in chunks:
+        for row in iter_sheet_rows(sheet_df):
+            row_number += 1
+            if row_number >= EXCEL_MAX_ROWS:
+                raise ValueError(f"Лист «{sheet_name}» содержит больше строк, чем допускает Excel ({EXCEL_MAX_ROWS - 1})")
+            yield row
+
+def write_xlsx_xlsxwriter(output_file_name, sheets):
+    # constant_memory: каждая строка сбрасывается на диск сразу после записи
+    workbook = xlsxwriter.Workbook(output_file_name, {
+        'constant_memory': True,
+        'strings_to_numbers': False,
+        'strings_to_formulas': False,
+        'strings_to_urls': False,
+    })
+    header_format = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+    try:
+        for sheet_name, sheet in sheets.items():
+            columns, widths, chunks = sheet_layout(sheet_name, sheet)
+            worksheet = workbook.add_worksheet(sheet_name)
+            for i, width in enumerate(widths):
+                worksheet.set_column(i, i, width)
+            worksheet.write_row(0, 0, [str(name) for name in columns], header_format)
+            for row_number, row in enumerate(iter_xlsx_sheet_rows(sheet_name, chunks), 1):
+                worksheet.write_row(row_number, 0, row)
+    finally:
+        workbook.close()
+
+def write_xlsx_openpyxl(output_file_name, sheets):
+    # Режим write_only: строки пишутся потоком во временный файл, без объектов ячеек в памяти
+    workbook = openpyxl.Workbook(write_only=True)
+    side = Side(style='thin')
+    for sheet_name, sheet in sheets.items():
+        columns, widths, chunks = sheet_layout(sheet_name, sheet)
+        worksheet = workbook.create_sheet(sheet_name)
+        for i, width in enumerate(widths):
+            worksheet.column_dimensions[get_column_letter(i + 1)].width = width
+        header = []
+        for name in columns:
+            cell = WriteOnlyCell(worksheet, value=str(name))
+            cell.font = Font(bold=True)
+            cell.border = Border(left=side, right=side, top=side, bottom=side)
+            cell.alignment = Alignment(horizontal='center', vertical='top')
+            header.append(cell)
+        worksheet.append(header)
+        for row in iter_xlsx_sheet_rows(sheet_name, chunks):
+            worksheet.append(row)
+    workbook.save(output_file_name)
+
+OUTPUT_WRITERS = {
+    'xlsx': write_xlsx_report,
+    'csv': write_csv_report,
+    'parquet': write_parquet_report,
+    'sqlite': write_sqlite_report,
+    'jsonl': write_jsonl_report,
+}
+OUTPUT_EXTENSIONS = {'xlsx': 'xlsx', 'csv': 'csv', 'parquet': 'parquet', 'sqlite': 'sqlite', 'db': 'sqlite', 'jsonl': 'jsonl'}
+
+def open_history(db_path):
+    connection = sqlite3.connect(db_path, timeout=60)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(HISTORY_SCHEMA)
+    return connection
+
+def store_history(db_path, df, domain):
+    # Ежедневные колонки «ГГГГ-ММ-ДД_метрика» переводятся в длинный формат
+    # (ключ, дата, метрика, значение). Пересекающиеся выгрузки не дублируют
+    # данные: повторная запись того же дня обновляет значение
+    daily = [(name, match.group(1), match.group(2)) for name in df.columns
+             if (match := DAILY_COLUMN_RE.match(str(name)))]
+    if not daily:
+        return 0
+
+    queries = df['Query'].astype(object).where(df['Query'].notna(), '').astype(str).to_numpy()
+    urls = df['Url'].astype(object).where(df['Url'].notna(), '').astype(str).to_numpy() if 'Url' in df else np.full(len(df), '', dtype=object)
+    keys = pd.MultiIndex.from_arrays([queries, urls])
+    codes, uniques = keys.factorize()
+
+    with closing(open_history(db_path)) as connection, connection:
+        # Ключи выгрузки кладутся во временную таблицу, и их номера находятся
+        # одним соединением по уникальному индексу: читаются только ключи этой
+        # выгрузки, а не вся история домена
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS export_keys '
+                           '(code INTEGER PRIMARY KEY, query TEXT NOT NULL, url TEXT NOT NULL)')
+        connection.execute('DELETE FROM export_keys')
+        connection.executemany('INSERT INTO export_keys (code, query, url) VALUES (?, ?, ?)',
+                               ((code, query, url) for code, (query, url) in enumerate(uniques)))
+        connection.execute('INSERT OR IGNORE INTO history_keys (domain, query, url) '
+                           'SELECT ?, query, url FROM export_keys ORDER BY code', (domain,))
+        ids = np.empty(len(uniques), dtype=np.int64)
+        for code, key_id in connection.execute(
+                'SELECT e.code, k.id FROM export_keys e '
+                'JOIN history_keys k ON k.domain = ? AND k.query = e.query AND k.url = e.url', (domain,)):
+            ids[code] = key_id
+        key_ids = ids[codes]
+
+        stored = 0
+        for name, date, metric in daily:
+            values = df[name].to_numpy(dtype=np.float64)
+            present = ~np.isnan(values)
+            connection.executemany(
+                'INSERT INTO history (key_id, date, metric, value) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (key_id, date, metric) DO UPDATE SET value = excluded.value',
+                zip(key_ids[present].tolist(), repeat(date), repeat(metric), values[present].tolist()),
+            )
+            stored += int(present.sum())
+    return stored
+
+def read_history(db_path, domain, date_from=None, date_to=None, metrics=None):
+    sql = ('SELECT k.query AS "Query", k.url AS "Url", h.date, h.metric, h.value '
+           'FROM history h JOIN history_keys k ON k.id = h.key_id WHERE k.domain = ?')
+    params = [domain]
+    if date_from:
+        sql += ' AND h.date >= ?'
+        params.append(date_from)
+    if date_to:
+        sql += ' AND h.date <= ?'
+        params.append(date_to)
+    if metrics:
+        sql += f" AND h.metric IN ({', '.join('?' * len(metrics))})"
+        params.extend(metrics)
+    with closing(open_history(db_path)) as connection:
+        return pd.read_sql_query(sql, connection, params=params)
+
+def site_domain(site_url):
+    return site_url.split('//')[-1].split('/')[0]
+
+def report_file_name(input_file, mode, site_url, out_dir='.', with_source=False, output_format='xlsx'):
+    return os.path.join(out_dir, create_output_file_name(input_file, site_domain(site_url), mode, with_source, output_format))
+
+def run_report(df, input_file, mode, site_url, urls_set=None, out_dir='.', with_source=False,
+               output_format='xlsx', output_file_name=None, top=None, timings=None,
+               ngram_min_support=NGRAM_MIN_SUPPORT, cluster_threshold=None, normalize_words=True, dictionaries=None,
+               dedup=False):
+    sheets = build_report(df, mode, site_url, urls_set, timings, ngram_min_support, cluster_threshold, normalize_words,
+                          dictionaries, dedup)
+    if top:
+        main_sheet = next(iter(sheets))
+        sheets[main_sheet] = sheets[main_sheet].nlargest(top, SORT_COLUMNS[mode])
+    if output_file_name is None:
+        output_file_name = report_file_name(input_file, mode, site_url, out_dir, with_source, output_format)
+    with stage(timings, 'write'):
+        written = write_report(output_file_name, sheets, output_format)
+    return ', '.join(written), len(next(iter(sheets.values())))
+
+def process_file(input_file, site_url, urls_set=None, mode=None, out_dir='.', use_cache=True, with_source=False,
+                 output_format='xlsx', output_file_name=None, history_db=None, chunk_rows=None, top=None,
+                 timings=None, ngram_min_support=NGRAM_MIN_SUPPORT, cluster_threshold=None, normalize_words=True,
+                 dictionaries=None, dedup=False):
+    if chunk_rows:
+        return process_file_chunked(input_file, site_url, urls_set, mode, out_dir, with_source, output_format,
+                                    output_file_name, history_db, chunk_rows, top, timings, ngram_min_support,
+                                    normalize_words, dictionaries)
+
+    with stage(timings, 'load'):
+        df = load_data(input_file, mode, use_cache, all_metrics=bool(history_db))
+    if df is None:
+        raise FileNotFoundError(f'Файл {input_file} не найден.')
+
+    if mode is None:
+        with stage(timings, 'detect'):
+            mode = determine_report_type(df)
+    if mode is None:
+        raise ValueError("Не удалось определить тип отчета. Проверьте структуру файла.")
+
+    if history_db:
+        with stage(timings, 'history'):
+            stored = store_history(history_db, df, site_domain(site_url))
+        print(f"\nВ историю {history_db} записано значений: {stored}")
+
+    output_file_name, num_rows = run_report(df, input_file, mode, site_url, urls_set, out_dir, with_source,
+                                            output_format, output_file_name, top, timings, ngram_min_support,
+                                            cluster_threshold, normalize_words, dictionaries, dedup)
+    return {'file': input_file, 'output': output_file_name, 'mode': mode, 'rows': num_rows}
+
+def plain_columns(df):
+    # Категории у разных кусков разные, поэтому в файлы-прогоны и в
+    # результат текстовые колонки попадают обычными строками
+    categorical = [name for name in df.columns if isinstance(df[name].dtype, pd.CategoricalDtype)]
+    return df.astype({name: object for name in categorical}) if categorical else df
+
+def conform_dtypes(df, dtypes):
+    # Сумма по куску без пропусков целая, а по куску с пропусками дробная.
+    # Приводим куски к типам первого куска, если это не теряет значений
+    for name, dtype in dtypes.items():
+        column = df[name]
+        if column.dtype == dtype:
+            continue
+        if dtype.kind == 'f' and column.dtype.kind in 'iu':
+            df[name] = column.astype(dtype)
+        elif dtype.kind == 'i' and column.dtype.kind == 'f' and column.notna().all() and (column == np.floor(column)).all():
+            df[name] = column.astype(dtype)
+    return df
+
+def keep_top(top_df, df, top, column):
+    if top_df is not None:
+        df = pd.concat([top_df, df], ignore_index=True)
+    return df.nlargest(top, column)
+
+def spool_chunk(file, df, mask, chunk_rows):
+    # Файл-прогон — последовательность pickle-записей (кусок, маска фильтра),
+    # которую потом можно читать по одной записи. Пустой кусок тоже
+    # записывается, чтобы при чтении были известны колонки
+    for start in range(0, max(len(df), 1), chunk_rows):
+        pickle.dump((df.iloc[start:start + chunk_rows], mask[start:start + chunk_rows]), file, pickle.HIGHEST_PROTOCOL)
+
+def iter_spooled(path, use_mask):
+    with open(path, 'rb') as file:
+        while True:
+            try:
+                df, mask = pickle.load(file)
+            except EOFError:
+                return
+            yield df[mask] if use_mask else df
+
+def iter_merged_runs(paths, column, use_mask, chunk_rows):
+    # Каждый прогон уже отсортирован по убыванию column, поэтому общий порядок
+    # получается слиянием: в памяти только по одному куску на прогон
+    runs = [chain.from_iterable(df.itertuples(index=False, name=None) for df in iter_spooled(path, use_mask))
+            for path in paths]
+    columns = next(iter_spooled(paths[0], False)).columns
+    position = columns.get_loc(column)
+    rows = []
+    yielded = False
+    for row in heapq.merge(*runs, key=lambda row: row[position], reverse=True):
+        rows.append(row)
+        if len(rows) == chunk_rows:
+            yield pd.DataFrame.from_records(rows, columns=columns)
+            rows = []
+            yielded = True
+    if rows or not yielded:
+        yield pd.DataFrame.from_records(rows, columns=columns)
+
+def merge_ngram_counts(total_df, ngram_df, rows_before, rows_seen, bucket_rows=NGRAM_BUCKET_ROWS):
+    # Lossy counting (Manku, Motwani) по ключам n-грамм. Запросы делятся на
+    # корзины по bucket_rows; новая n-грамма получает допуск delta — число
+    # корзин, пройденных до ее куска, и после каждого куска выбрасываются
+    # n-граммы, у которых Количество + delta не больше числа пройденных корзин.
+    # Таблица не растет с размером файла, а Количество и суммы занижены не
+    # больше чем на rows_seen / bucket_rows запросов
+    ngram_df = ngram_df.assign(delta=rows_before // bucket_rows)
+    if total_df is not None:
+        grouped = pd.concat([total_df, ngram_df]).groupby(level=0, sort=False)
+        ngram_df = grouped.sum()
+        ngram_df['delta'] = grouped['delta'].min()
+    return ngram_df[ngram_df['Количество'] + ngram_df['delta'] > rows_seen // bucket_rows]
+
+def iter_conformed(chunks, dtypes):
+    for df in chunks:
+        yield conform_dtypes(df, dtypes)
+
+def process_file_chunked(input_file, site_url, urls_set=None, mode=None, out_dir='.', with_source=False,
+                         output_format='xlsx', output_file_name=None, history_db=None, chunk_rows=100000, top=None,
+                         timings=None, ngram_min_support=NGRAM_MIN_SUPPORT, normalize_words=True, dictionaries=None):
+    # Выгрузка читается и обрабатывается кусками по chunk_rows строк. Готовые
+    # куски сбрасываются во временные файлы-прогоны, статистика слов копится в
+    # счетчике, а результат собирается слиянием прогонов при записи
+    if not os.path.exists(input_file):
+        raise FileNotFoundError(f'Файл {input_file} не найден.')
+    if not zipfile.is_zipfile(input_file):
+        raise ValueError('обработка кусками (--chunk-size) поддерживает только файлы .xlsx')
+
+    chunks = iter_xlsx_chunks(input_file, mode, chunk_rows, all_metrics=bool(history_db))
+    with stage(timings, 'load'):
+        first = next(chunks)
+    if mode is None:
+        with stage(timings, 'detect'):
+            mode = determine_report_type(first)
+    if mode is None:
+        raise ValueError("Не удалось определить тип отчета. Проверьте структуру файла.")
+    if mode == 1:
+        print(f"\nОбнаружен отчет по поисковым запросам. Обработка кусками по {chunk_rows} строк...")
+    else:
+        print(f"\nОбнаружен отчет по страницам. Обработка кусками по {chunk_rows} строк...")
+
+    if urls_set:
+        exact, regex = compile_url_patterns(urls_set, site_url)
+    domain = site_domain(site_url)
+    column = SORT_COLUMNS[mode]
+    # Пока не прочитан весь файл, неизвестно, найдется ли хоть один URL из
+    # urls.txt, поэтому итоги копятся и для всех строк, и для отфильтрованных
+    total_rows = matched_rows = stored = 0
+    word_counts = {False: Counter(), True: Counter()}
+    ngram_totals = {(n, use_mask): None for n in NGRAM_SHEETS for use_mask in (False, True)}
+    ngram_rows = {False: 0, True: 0}
+    ngram_words = {}
+    # Пары (запрос, URL) копятся уже сложенными; URL-фильтр применяется к ним
+    # в конце, поэтому отдельная копия для отфильтрованных строк не нужна
+    cannibalization_parts = []
+    summary_parts = []
+    top_dfs = {False: None, True: None}
+
+    with tempfile.TemporaryDirectory(prefix='qma-') as spool_dir:
+        runs = []
+        chunks = chain([first], chunks)
+        del first
+        while True:
+            # Время этапов суммируется по всем кускам
+            with stage(timings, 'load'):
+                df = next(chunks, None)
+            if df is None:
+                break
+            if history_db:
+                with stage(timings, 'history'):
+                    stored += store_history(history_db, df, domain)
+            with stage(timings, 'metrics'):
+                if mode == 1:
+                    tokens = tokenize_queries(df['Query'])
+                    result_df = process_queries_data(df, site_url, tokens, dictionaries)
+                else:
+                    result_df = process_pages_data(df, site_url)
+                    summary_rows = page_summary_rows(result_df, df)
+            del df
+            with stage(timings, 'filter'):
+                mask = match_urls(result_df['Url'], exact, regex, site_url) if urls_set else np.ones(len(result_df), dtype=bool)
+            total_rows += len(result_df)
+            matched_rows += int(mask.sum())
+
+            if mode == 2:
+                # Фильтр по URL применяется к итоговым суммам, поэтому суммы
+                # по страницам копятся в одном экземпляре
+                with stage(timings, 'page_summary'):
+                    append_sums(summary_parts, sum_by_url(summary_rows), sum_by_url, chunk_rows)
+                del summary_rows
+
+            if mode == 1:
+                with stage(timings, 'words'):
+                    for use_mask, rows in ((False, result_df), (True, result_df[mask])):
+                        counts = create_word_count_df(rows, tokens)
+                        word_counts[use_mask].update(dict(zip(counts['Слово'].tolist(), counts['Количество'].tolist())))
+                if ngram_min_support is not None:
+                    # Порог применяется только к итогам по всему файлу
+                    with stage(timings, 'ngrams'):
+                        for use_mask, rows in ((False, result_df), (True, result_df[mask])):
+                            if use_mask and not urls_set:
+                                continue
+                            for n in NGRAM_SHEETS:
+                                ngram_totals[n, use_mask] = merge_ngram_counts(
+                                    ngram_totals[n, use_mask], ngram_chunk_counts(rows, tokens, n, ngram_words),
+                                    ngram_rows[use_mask], ngram_rows[use_mask] + len(rows))
+                            ngram_rows[use_mask] += len(rows)
+
+            with stage(timings, 'cannibalization'):
+                append_sums(cannibalization_parts, cannibalization_pairs(result_df), sum_by_pair, chunk_rows)
+
+            with stage(timings, 'spool'):
+                result_df = plain_columns(result_df)
+                if top:
+                    top_dfs[False] = keep_top(top_dfs[False], result_df, top, column)
+                    top_dfs[True] = keep_top(top_dfs[True], result_df[mask], top, column)
+                else:
+                    path = os.path.join(spool_dir, f'run-{len(runs)}.pickle')
+                    with open(path, 'wb') as file:
+                        spool_chunk(file, result_df, mask, chunk_rows)
+                    runs.append(path)
+
+        if history_db:
+            print(f"\nВ историю {history_db} записано значений: {stored}")
+
+        use_mask = bool(urls_set) and matched_rows > 0
+        if urls_set and not matched_rows:
+            print("\nВНИМАНИЕ: Ни один URL из файла urls.txt не найден в данных!")
+        elif urls_set:
+            print(f"\nОтфильтровано записей: {matched_rows} из {total_rows}")
+
+        if top:
+            main_sheet = top_dfs[use_mask]
+            num_rows = len(main_sheet)
+        else:
+            num_rows = matched_rows if use_mask else total_rows
+            dtypes = next(iter_spooled(runs[0], False)).dtypes
+            if mode == 1:
+                main_sheet = iter_merged_runs(runs, column, use_mask, chunk_rows)
+            else:
+                main_sheet = chain.from_iterable(iter_spooled(path, use_mask) for path in runs)
+            main_sheet = iter_conformed(main_sheet, dtypes)
 
         if mode == 1:
-            word_count_df.to_excel(writer, index=False, sheet_name='Статистика слов')
-            writer.sheets['Статистика слов'].column_dimensions['A'].width = 25
-            writer.sheets['Статистика слов'].column_dimensions['B'].width = 25
+            counts = word_counts[use_mask]
+            word_count_df = pd.DataFrame({'Слово': list(counts), 'Количество': list(counts.values())})
+            if normalize_words:
+                word_count_df = normalize_word_counts(word_count_df)
+            sheets = {'Семантическое ядро': main_sheet,
+                      'Статистика слов': sort_word_counts(word_count_df)}
+            if ngram_min_support is not None:
+                words = list(ngram_words)
+                for n, sheet_name in NGRAM_SHEETS.items():
+                    ngram_df = ngram_totals[n, use_mask].drop(columns='delta')
+                    ngram_df = ngram_df[ngram_df['Количество'] >= ngram_min_support]
+                    ngram_df.insert(0, 'Фраза', ngram_phrases(ngram_df.index.to_numpy(), words, n))
+                    sheets[sheet_name] = ngram_df.sort_values(by=['Количество', 'Сум. частотность'], ascending=False,
+                                                              ignore_index=True)
+        else:
+            with stage(timings, 'page_summary'):
+                sums = sum_by_url(pd.concat(summary_parts, ignore_index=True))
+                if use_mask:
+                    sums = sums[match_urls(sums['Url'], exact, regex, site_url)]
+                summary_df = create_page_summary_df(sums, site_url)
+            sheets = {'Страницы': main_sheet, 'Сводка по страницам': summary_df}
+        with stage(timings, 'cannibalization'):
+            pairs = sum_by_pair(pd.concat(cannibalization_parts, ignore_index=True))
+            if use_mask:
+                pairs = pairs[match_urls(pairs['Url'], exact, regex, site_url)]
+            sheets['Каннибализация'] = create_cannibalization_df(pairs)
+        del cannibalization_parts
 
-    num_queries = len(result_df)
-    processing_time = time.process_time()
+        if output_file_name is None:
+            output_file_name = report_file_name(input_file, mode, site_url, out_dir, with_source, output_format)
+        with stage(timings, 'write'):
+            written = write_report(output_file_name, sheets, output_format)
+
+    return {'file': input_file, 'output': ', '.join(written), 'mode': mode, 'rows': num_rows}
+
+def comparable_rows(result_df, mode):
+    # Одна строка на ключ сравнения. В отчете по запросам один запрос может
+    # вести на несколько URL: такие строки складываются, позиция взвешивается
+    # показами, охват пересчитывается, URL берется самый частотный
+    columns = ['Url', 'Query', *COMPARE_METRICS[mode]]
+    rows = result_df[columns].astype({'Url': object, 'Query': object})
+    if mode == 2:
+        return rows.drop_duplicates(COMPARE_KEYS[mode])
+    repeated = rows['Query'].duplicated(keep=False)
+    if not repeated.any():
+        return rows
+    repeated_rows = rows[repeated].assign(weighted=rows['Ср. позиция'] * rows['Сум. показов за 14 дн'])
+    repeated_rows = repeated_rows.sort_values(SORT_COLUMNS[mode], ascending=False, kind='stable')
+    grouped = repeated_rows.groupby('Query', sort=False)
+    sums = grouped[['Сум. частотность за 14 дн', 'Сум. показов за 14 дн', 'Сум. кликов за 14 дн.', 'weighted']].sum()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        position = sums.pop('weighted') / sums['Сум. показов за 14 дн']
+    merged = sums.assign(**{'Url': grouped['Url'].first(),
+                            'Ср. позиция': round_position(position.to_numpy(), sums.index)})
+    merged['Охват'] = round(merged['Сум. показов за 14 дн'] / merged['Сум. частотность за 14 дн'] * 100, 1)
+    return pd.concat([rows[~repeated], merged.reset_index()[columns]], ignore_index=True)
+
+def create_compare_sheets(old_df, new_df, mode, top=COMPARE_TOP):
+    # Хэш-соединение по ключу (merge how='outer'): строки только новой выгрузки —
+    # новые запросы, только старой — потерянные. Разница — «стало» минус «было»;
+    # отсутствующие суммы считаются нулями, а разница позиции и охвата — только
+    # для строк, которые есть в обеих выгрузках. Рост позиции в минус — улучшение
+    keys, metrics = COMPARE_KEYS[mode], COMPARE_METRICS[mode]
+    old_rows, new_rows = comparable_rows(old_df, mode), comparable_rows(new_df, mode)
+    if mode == 1:
+        old_rows = old_rows.rename(columns={'Url': 'Url (было)'})
+    joined = old_rows.merge(new_rows, on=keys, how='outer', suffixes=(' (было)', ' (стало)'), indicator=True, sort=False)
+    if mode == 1:
+        joined['Url'] = joined['Url'].fillna(joined.pop('Url (было)'))
+
+    compare_df = joined[['Url', 'Query']].copy()
+    compare_df['Статус'] = joined['_merge'].map({'both': 'Общий', 'right_only': 'Новый', 'left_only': 'Потерян'}).astype(object)
+    both = (joined['_merge'] == 'both').to_numpy()
+    for metric in metrics:
+        old, new = joined[f'{metric} (было)'], joined[f'{metric} (стало)']
+        if metric in ('Ср. позиция', 'Охват'):
+            valid = both & (old > 0).to_numpy() & (new > 0).to_numpy() if metric == 'Ср. позиция' else both
+            delta = np.round(np.where(valid, new - old, np.nan), 1)
+        else:
+            old, new = old.fillna(0), new.fillna(0)
+            if new_rows[metric].dtype.kind in 'iu' and old_rows[metric].dtype.kind in 'iu':
+                old, new = old.astype(np.int64), new.astype(np.int64)
+            delta = new - old
+        compare_df[f'{metric} (было)'] = old
+        compare_df[f'{metric} (стало)'] = new
+        compare_df[f'Δ {metric}'] = delta
+
+    column = SORT_COLUMNS[mode]
+    by_volume = np.maximum(compare_df[f'{column} (стало)'].fillna(0), compare_df[f'{column} (было)'].fillna(0))
+    compare_df = compare_df.iloc[np.argsort(-by_volume.to_numpy(), kind='stable')].reset_index(drop=True)
+
+    new_columns = keys + [f'{metric} (стало)' for metric in metrics]
+    lost_columns = keys + [f'{metric} (было)' for metric in metrics]
+    if mode == 1:
+        new_columns.insert(1, 'Url')
+        lost_columns.insert(1, 'Url')
+    clicks = 'Δ Сум. кликов за 14 дн.'
+    # Рост и падение — по изменению кликов, при равенстве — по изменению показов
+    ranked = compare_df.sort_values([clicks, 'Δ Сум. показов за 14 дн'], ascending=False, kind='stable')
+    return {
+        'Сравнение': compare_df,
+        'Новые запросы': compare_df.loc[compare_df['Статус'] == 'Новый', new_columns].reset_index(drop=True),
+        'Потерянные запросы': compare_df.loc[compare_df['Статус'] == 'Потерян', lost_columns].reset_index(drop=True),
+        'Рост': ranked[ranked[clicks] > 0].head(top).reset_index(drop=True),
+        'Падение': ranked[ranked[clicks] < 0].iloc[::-1].head(top).reset_index(drop=True),
+    }
+
+def load_report_rows(input_file, site_url, urls_set=None, mode=None, use_cache=True):
+    df = load_data(input_file, mode, use_cache)
+    if df is None:
+        raise FileNotFoundError(f'Файл {input_file} не найден.')
+    if mode is None:
+        mode = determine_report_type(df)
+    if mode is None:
+        raise ValueError(f"Не удалось определить тип отчета {input_file}. Проверьте структуру файла.")
+    if mode == 1:
+        result_df = process_queries_data(df, site_url)
+    else:
+        result_df = process_pages_data(df, site_url)
+    if urls_set:
+        result_df = filter_by_urls(result_df, urls_set, site_url)
+    return result_df, mode
+
+def compare_files(old_file, new_file, site_url, urls_set=None, mode=None, out_dir='.', use_cache=True,
+                  output_format='xlsx', output_file_name=None, top=COMPARE_TOP, timings=None):
+    with stage(timings, 'load'):
+        old_df, old_mode = load_report_rows(old_file, site_url, urls_set, mode, use_cache)
+        new_df, new_mode = load_report_rows(new_file, site_url, urls_set, mode, use_cache)
+    if old_mode != new_mode:
+        raise ValueError(f'Выгрузки разных типов: {old_file} и {new_file}')
+
+    with stage(timings, 'compare'):
+        sheets = create_compare_sheets(old_df, new_df, new_mode, top)
+    if output_file_name is None:
+        name = f"{site_domain(site_url)}-compare-{datetime.now().strftime('%Y-%m-%d')}.{output_format}"
+        output_file_name = os.path.join(out_dir, name)
+    with stage(timings, 'write'):
+        written = write_report(output_file_name, sheets, output_format)
+    statuses = sheets['Сравнение']['Статус'].value_counts()
+    return {'output': ', '.join(written), 'mode': new_mode, 'rows': len(sheets['Сравнение']),
+            'common': int(statuses.get('Общий', 0)), 'new': int(statuses.get('Новый', 0)),
+            'lost': int(statuses.get('Потерян', 0))}
+
+def process_file_task(task):
+    # Выполняется в отдельном процессе пула: ошибки не пробрасываются,
+    # а возвращаются в сводку, чтобы один битый файл не останавливал пакет
+    input_file, options = task
+    options = dict(options)
+    profile_dir = options.pop('profile_dir', None)
+    timings = []
+    profiler = cProfile.Profile() if profile_dir else None
+    if profiler:
+        tracemalloc.start()
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    try:
+        if profiler:
+            profiler.enable()
+        try:
+            result = process_file(input_file, timings=timings, **options)
+        finally:
+            if profiler:
+                profiler.disable()
+        result['error'] = None
+    except Exception as e:
+        result = {'file': input_file, 'output': None, 'mode': None, 'rows': 0, 'error': str(e)}
+    finally:
+        if profiler:
+            tracemalloc.stop()
+    result['seconds'] = time.perf_counter() - started
+    result['cpu_seconds'] = time.process_time() - cpu_started
+    result['stages'] = summarize_stages(timings)
+    if profiler:
+        result['profile'] = os.path.join(profile_dir, f"{os.path.splitext(os.path.basename(input_file))[0]}.prof")
+        result['profile_stats'] = save_profile(profiler, result['profile'])
+    return result
+
+def available_cpus():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def run_tasks(tasks, jobs):
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield process_file_task(task)
+        return
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+        futures = {executor.submit(process_file_task, task): task[0] for task in tasks}
+        for future in as_completed(futures):
+            # Если процесс пула погиб (например, его убила система из-за
+            # нехватки памяти), все его незавершенные файлы попадают в сводку
+            # как ошибки, а не обрывают пакет
+            try:
+                yield future.result()
+            except Exception as e:
+                yield crashed_task_result(futures[future], e, time.perf_counter() - started)
+
+def crashed_task_result(input_file, error, seconds):
+    return {'file': input_file, 'output': None, 'mode': None, 'rows': 0,
+            'error': f'процесс обработки завершился аварийно: {error!r}',
+            'seconds': seconds, 'cpu_seconds': 0.0, 'stages': []}
+
+def print_batch_summary(results, wall_seconds, jobs):
+    name_width = max([len('Файл')] + [len(result['file']) for result in results])
+    print(f"\n*** Сводка: {len(results)} файлов, процессов: {jobs}")
+    print(f"{'Файл':<{name_width}}  {'Строк':>9}  {'Время, с':>9}  Результат")
+    for result in results:
+        status = result['output'] if result['error'] is None else f"ОШИБКА: {result['error']}"
+        print(f"{result['file']:<{name_width}}  {result['rows']:>9}  {result['seconds']:>9.2f}  {status}")
+    failed = sum(result['error'] is not None for result in results)
+    total_rows = sum(result['rows'] for result in results)
+    print(f"Всего строк: {total_rows}, ошибок: {failed}, общее время: {wall_seconds:.2f} с")
+    print(f"***")
+
+def print_result(output_file_name, mode, num_queries):
     print(f"\n***")
     print(f"Результат сохранен в файл {output_file_name}")
     if mode == 1:
@@ -229,7 +2683,454 @@ def main():
     elif mode == 2:
         print(f"Обработано адресов страниц: {num_queries}")
     print(f"***")
+
+def run_interactive():
+    input_file = select_file()
+    if input_file is None:
+        return
+
+    timings = []
+    with stage(timings, 'load'):
+        df = load_data(input_file)
+    if df is None:
+        input("\nНажмите Enter для завершения...")
+        return
+
+    with stage(timings, 'detect'):
+        mode = determine_report_type(df)
+    if mode is None:
+        print("Не удалось определить тип отчета. Проверьте структуру файла.")
+        input("\nНажмите Enter для завершения...")
+        return
+
+    site_url = input("\nПожалуйста, введите адрес сайта в формате https://site.ru: ")
+
+    # Загружаем URLs из файла
+    urls_set = load_urls_from_file()
+
+    dictionaries = None
+    if mode == 1:
+        brands = input("\nВведите брендовые запросы, например: Yandex, Яндекс, ya (или Enter для пропуска): ")
+        try:
+            dictionaries = load_dictionaries(brands=parse_list(brands))
+        except (OSError, ValueError) as e:
+            print(f"\nОшибка при чтении словарей: {e}")
+            dictionaries = load_dictionaries(None, parse_list(brands))
+
+    output_file_name, num_queries = run_report(df, input_file, mode, site_url, urls_set, timings=timings,
+                                               dictionaries=dictionaries)
+    processing_time = time.process_time()
+    print_result(output_file_name, mode, num_queries)
+    print_stages(summarize_stages(timings))
+    print(f"\nПроцессорное время: {processing_time:.2f} с")
     input("\nНажмите Enter для завершения...")
 
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description='Анализ выгрузок «Мониторинга запросов» Яндекс.Вебмастера без интерактивных вопросов. '
+                    'Без аргументов скрипт работает в обычном интерактивном режиме.',
+    )
+    parser.add_argument('files', nargs='*', help='файлы выгрузки или маски, например exports/*.xlsx')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='сравнить две выгрузки одного типа вместо обычной обработки')
+    parser.add_argument('--watch', metavar='INBOX',
+                        help=f'следить за папкой INBOX и обрабатывать новые выгрузки (готовые переносятся в '
+                             f'{WATCH_DONE_DIR}/ и {WATCH_FAILED_DIR}/ внутри нее)')
+    parser.add_argument('--poll', type=float, default=WATCH_POLL_SECONDS, metavar='SECONDS',
+                        help=f'интервал опроса папки для --watch (по умолчанию {WATCH_POLL_SECONDS:g} с)')
+    parser.add_argument('--site', required=True, help='адрес сайта в формате https://site.ru')
+    parser.add_argument('--urls', help='файл со списком URL для фильтрации (по одному на строку)')
+    parser.add_argument('--mode', choices=['auto', '1', '2'], default='auto',
+                        help='1 — отчет по запросам, 2 — отчет по страницам, auto — определить по файлу (по умолчанию)')
+    parser.add_argument('--out-dir', default='.', help='папка для результатов (по умолчанию текущая)')
+    parser.add_argument('--format', choices=list(OUTPUT_WRITERS),
+                        help='формат результата; по умолчанию определяется по расширению --output, иначе xlsx')
+    parser.add_argument('-o', '--output', help='имя файла результата (только для одного входного файла)')
+    parser.add_argument('--history', metavar='DB',
+                        help='база SQLite, в которую дописываются ежедневные метрики выгрузки для истории')
+    parser.add_argument('--read-history', metavar='DB',
+                        help='выгрузить ежедневные метрики сайта из базы истории вместо обычной обработки')
+    parser.add_argument('--date-from', metavar='YYYY-MM-DD', help='первый день для --read-history')
+    parser.add_argument('--date-to', metavar='YYYY-MM-DD', help='последний день для --read-history')
+    parser.add_argument('--metrics', type=parse_list, metavar='LIST',
+                        help='метрики для --read-history через запятую, например "shows, clicks" (по умолчанию все)')
+    parser.add_argument('--chunk-size', type=int, metavar='ROWS',
+                        help='обрабатывать выгрузку кусками по ROWS строк, не загружая ее в память целиком (только .xlsx)')
+    parser.add_argument('--top', type=int, metavar='N',
+                        help='оставить в основном листе только N строк с наибольшей суммарной частотностью (показами); '
+                             f'с --compare — число строк на листах «Рост» и «Падение» (по умолчанию {COMPARE_TOP})')
+    parser.add_argument('--raw-words', action='store_true',
+                        help='не приводить слова в «Статистике слов» к основе: считать каждую словоформу отдельно')
+    parser.add_argument('--ngram-min-support', type=int, default=NGRAM_MIN_SUPPORT, metavar='N',
+                        help=f'минимальное число запросов для листов «Биграммы» и «Триграммы» (по умолчанию {NGRAM_MIN_SUPPORT})')
+    parser.add_argument('--no-ngrams', action='store_true', help='не строить листы «Биграммы» и «Триграммы»')
+    parser.add_argument('--brands', type=parse_list, metavar='LIST',
+                        help='варианты написания бренда через запятую, например "Yandex, Яндекс*, ya"; «*» — искать во всех словоформах (колонка «Бренд»)')
+    parser.add_argument('--dictionaries', metavar='FILE',
+                        help=f'JSON со словарями брендов и интентов (по умолчанию {DICTIONARIES_FILE}, если он есть)')
+    parser.add_argument('--cluster', action='store_true',
+                        help='сгруппировать запросы в кластеры по общим словам и посадочному URL (только отчет по запросам)')
+    parser.add_argument('--cluster-threshold', type=float, default=CLUSTER_THRESHOLD, metavar='J',
+                        help=f'минимальное сходство Жаккара запросов одного кластера, от 0 до 1 (по умолчанию {CLUSTER_THRESHOLD})')
+    parser.add_argument('--dedup', action='store_true',
+                        help='найти дубли запросов: перестановки слов и опечатки (только отчет по запросам)')
+    parser.add_argument('--profile', action='store_true',
+                        help='вывести время и память по этапам и сохранить профиль cProfile в --out-dir')
+    parser.add_argument('--run-log', metavar='FILE',
+                        help='дописывать в FILE журнал запусков в формате JSON Lines (время и память по этапам)')
+    parser.add_argument('--no-cache', action='store_true', help=f'не использовать кэш разобранных файлов в {CACHE_DIR}')
+    parser.add_argument('--jobs', type=int, default=available_cpus(),
+                        help='число параллельных процессов для пакетной обработки (по умолчанию — число доступных ядер)')
+    return parser
+
+def expand_input_files(patterns):
+    files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        for file in matches:
+            if file not in files:
+                files.append(file)
+    return files
+
+def run_batch(argv):
+    args = build_arg_parser().parse_args(argv)
+
+    files = expand_input_files(args.files)
+    if args.read_history:
+        if files or args.compare or args.watch:
+            print('С --read-history нельзя указывать входные файлы, --compare и --watch.', file=sys.stderr)
+            return EXIT_USAGE
+        if not os.path.exists(args.read_history):
+            print(f'Файл {args.read_history} не найден.', file=sys.stderr)
+            return EXIT_USAGE
+        for value in (args.date_from, args.date_to):
+            if value and not re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+                print(f'Дата {value} должна быть в формате ГГГГ-ММ-ДД.', file=sys.stderr)
+                return EXIT_USAGE
+        unknown = [metric for metric in args.metrics or () if metric not in DAILY_METRICS]
+        if unknown:
+            print(f"Неизвестные метрики: {', '.join(unknown)}. Допустимые: {', '.join(DAILY_METRICS)}.", file=sys.stderr)
+            return EXIT_USAGE
+        files = [args.read_history]
+    elif args.compare:
+        if files:
+            print('С --compare входные файлы задаются только как OLD и NEW.', file=sys.stderr)
+            return EXIT_USAGE
+        missing = [file for file in args.compare if not os.path.exists(file)]
+        if missing:
+            print(f'Файл {missing[0]} не найден.', file=sys.stderr)
+            return EXIT_USAGE
+        files = args.compare[1:]
+    if args.watch:
+        if files or args.compare or args.output:
+            print('С --watch нельзя указывать входные файлы, --compare и --output.', file=sys.stderr)
+            return EXIT_USAGE
+        if not os.path.isdir(args.watch):
+            print(f'Папка {args.watch} не найдена.', file=sys.stderr)
+            return EXIT_USAGE
+        if args.poll <= 0:
+            print('--poll должен быть положительным числом.', file=sys.stderr)
+            return EXIT_USAGE
+    elif not files:
+        print('Не найдено ни одного входного файла.', file=sys.stderr)
+        return EXIT_USAGE
+
+    urls_set = None
+    if args.urls:
+        if not os.path.exists(args.urls):
+            print(f'Файл {args.urls} не найден.', file=sys.stderr)
+            return EXIT_USAGE
+        urls_set = load_urls_from_file(args.urls)
+
+    output_format = args.format
+    if args.output:
+        if len(files) > 1:
+            print('--output можно указать только для одного входного файла, используйте --out-dir.', file=sys.stderr)
+            return EXIT_USAGE
+        output_format = output_format or output_format_from_name(args.output)
+        if output_format is None:
+            print(f'Не удалось определить формат по имени {args.output}, укажите --format.', file=sys.stderr)
+            return EXIT_USAGE
+    output_format = output_format or 'xlsx'
+    if output_format == 'parquet' and pyarrow is None:
+        print('Для формата parquet нужна библиотека pyarrow (pip install pyarrow).', file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.chunk_size is not None and args.chunk_size <= 0 or args.top is not None and args.top <= 0 \
+            or args.ngram_min_support <= 0:
+        print('--chunk-size, --top и --ngram-min-support должны быть положительными числами.', file=sys.stderr)
+        return EXIT_USAGE
+    if not 0 < args.cluster_threshold <= 1:
+        print('--cluster-threshold должен быть в диапазоне (0, 1].', file=sys.stderr)
+        return EXIT_USAGE
+    if args.cluster and args.chunk_size:
+        print('Кластеризации нужны все запросы сразу, --cluster нельзя совместить с --chunk-size.', file=sys.stderr)
+        return EXIT_USAGE
+    if args.dedup and args.chunk_size:
+        print('Поиску дублей нужны все запросы сразу, --dedup нельзя совместить с --chunk-size.', file=sys.stderr)
+        return EXIT_USAGE
+
+    if args.dictionaries and not os.path.exists(args.dictionaries):
+        print(f'Файл {args.dictionaries} не найден.', file=sys.stderr)
+        return EXIT_USAGE
+    try:
+        dictionaries = load_dictionaries(args.dictionaries or DICTIONARIES_FILE, args.brands)
+    except (OSError, ValueError) as e:
+        print(f'Ошибка при чтении словарей: {e}', file=sys.stderr)
+        return EXIT_USAGE
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    mode = None if args.mode == 'auto' else int(args.mode)
+
+    if args.compare:
+        return run_compare(args, urls_set, mode, output_format)
+    if args.read_history:
+        return run_read_history(args, output_format)
+
+    options = {
+        'site_url': args.site,
+        'urls_set': urls_set,
+        'mode': mode,
+        'out_dir': args.out_dir,
+        'use_cache': not args.no_cache,
+        'with_source': len(files) > 1 or bool(args.watch),
+        'output_format': output_format,
+        'output_file_name': args.output,
+        'history_db': args.history,
+        'chunk_rows': args.chunk_size,
+        'top': args.top,
+        'profile_dir': args.out_dir if args.profile else None,
+        'ngram_min_support': None if args.no_ngrams else args.ngram_min_support,
+        'cluster_threshold': args.cluster_threshold if args.cluster else None,
+        'normalize_words': not args.raw_words,
+        'dictionaries': dictionaries,
+        'dedup': args.dedup,
+    }
+    if args.watch:
+        # Каждый файл обрабатывается один раз, кэш только занимал бы место
+        options['use_cache'] = False
+        return watch_inbox(args.watch, options, max(1, args.jobs), args.poll, args.run_log)
+
+    tasks = [(input_file, options) for input_file in files]
+    jobs = max(1, min(args.jobs, len(tasks)))
+
+    started = time.perf_counter()
+    results = []
+    for result in run_tasks(tasks, jobs):
+        if result['error'] is None:
+            print_result(result['output'], result['mode'], result['rows'])
+        else:
+            print(f"\nОшибка при обработке {result['file']}: {result['error']}", file=sys.stderr)
+        if args.profile and 'profile' in result:
+            print(f"\nЭтапы обработки {result['file']}:")
+            print_stages(result['stages'])
+            print(f"\nПрофиль cProfile сохранен в {result['profile']}, самые дорогие функции:")
+            print(result['profile_stats'])
+        if args.run_log:
+            append_run_log(args.run_log, result, options)
+        results.append(result)
+
+    if len(results) > 1:
+        order = {input_file: i for i, input_file in enumerate(files)}
+        results.sort(key=lambda result: order[result['file']])
+        print_batch_summary(results, time.perf_counter() - started, jobs)
+
+    return EXIT_FAILED if any(result['error'] is not None for result in results) else EXIT_OK
+
+def run_compare(args, urls_set, mode, output_format):
+    old_file, new_file = args.compare
+    timings = []
+    try:
+        result = compare_files(old_file, new_file, args.site, urls_set, mode, args.out_dir, not args.no_cache,
+                               output_format, args.output, args.top or COMPARE_TOP, timings)
+    except Exception as e:
+        print(f"\nОшибка при сравнении {old_file} и {new_file}: {e}", file=sys.stderr)
+        return EXIT_FAILED
+    print(f"\n***")
+    print(f"Сравнение сохранено в файл {result['output']}")
+    print(f"Общих: {result['common']}, новых: {result['new']}, потерянных: {result['lost']}")
+    print(f"***")
+    if args.profile:
+        print_stages(summarize_stages(timings))
+    return EXIT_OK
+
+def run_read_history(args, output_format):
+    domain = site_domain(args.site)
+    try:
+        df = read_history(args.read_history, domain, args.date_from, args.date_to, args.metrics)
+        output_file_name = args.output or os.path.join(
+            args.out_dir, f"{domain}-history-{datetime.now().strftime('%Y-%m-%d')}.{output_format}")
+        written = write_report(output_file_name, {'История': df}, output_format)
+    except (sqlite3.Error, OSError, ValueError) as e:
+        print(f"\nОшибка при чтении истории {args.read_history}: {e}", file=sys.stderr)
+        return EXIT_FAILED
+    print(f"\n***")
+    print(f"История сохранена в файл {', '.join(written)}")
+    print(f"Значений: {len(df)}")
+    print(f"***")
+    return EXIT_OK
+
+def scan_inbox(inbox):
+    # Снимок папки: размер и время изменения каждой выгрузки. os.scandir
+    # читает папку одним проходом; временные файлы Excel (~$...) пропускаются
+    snapshot = {}
+    with os.scandir(inbox) as entries:
+        for entry in entries:
+            if entry.name.endswith('.xlsx') and not entry.name.startswith('~$') and entry.is_file():
+                stat = entry.stat()
+                snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+def move_to(path, folder):
+    # Файл с тем же именем уже мог быть обработан раньше: к новому добавляется время
+    target = os.path.join(folder, os.path.basename(path))
+    if os.path.exists(target):
+        stem, extension = os.path.splitext(os.path.basename(path))
+        target = os.path.join(folder, f"{stem}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{extension}")
+    shutil.move(path, target)
+    return target
+
+def print_watch_summary(finished, wall_seconds):
+    processed = [result for result in finished if result['error'] is None]
+    print(f"\n*** Сводка слежения за {wall_seconds:.1f} с")
+    print(f"Файлов: {len(finished)}, ошибок: {len(finished) - len(processed)}, "
+          f"строк: {sum(result['rows'] for result in processed)}")
+    if finished:
+        latencies = np.array([result['latency'] for result in finished])
+        seconds = np.array([result['seconds'] for result in finished])
+        print(f"Пропускная способность: {len(finished) / wall_seconds * 60:.2f} файлов/мин, "
+              f"{sum(result['rows'] for result in processed) / wall_seconds:.0f} строк/с")
+        print(f"Задержка от появления файла до результата, с: медиана {np.median(latencies):.2f}, "
+              f"p95 {np.percentile(latencies, 95):.2f}, макс. {latencies.max():.2f}")
+        print(f"Время обработки файла, с: среднее {seconds.mean():.2f}, макс. {seconds.max():.2f}")
+    print("***")
+
+def ignore_sigint():
+    # Инициализатор процессов пула слежения: Ctrl+C из терминала получает вся
+    # группа процессов, а останавливать обработку должен только основной
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def watch_inbox(inbox, options, jobs=1, poll_seconds=WATCH_POLL_SECONDS, run_log=None):
+    # Опрашивает папку inbox и обрабатывает новые и измененные выгрузки. Файл
+    # берется в работу, когда его размер и время изменения не менялись
+    # WATCH_STABLE_POLLS опросов подряд и он читается как целый zip (xlsx).
+    # В работе одновременно не больше jobs файлов; после обработки файл
+    # переносится в done или failed. Останавливается по Ctrl+C
+    done_dir, failed_dir = os.path.join(inbox, WATCH_DONE_DIR), os.path.join(inbox, WATCH_FAILED_DIR)
+    os.makedirs(done_dir, exist_ok=True)
+    os.makedirs(failed_dir, exist_ok=True)
+    pending = {}
+    running = {}
+    finished = []
+    started = time.perf_counter()
+    print(f"Слежение за папкой {inbox}, опрос каждые {poll_seconds:g} с, процессов: {jobs}. Ctrl+C — остановка")
+
+    # Сервисные менеджеры останавливают процесс сигналом SIGTERM: он
+    # обрабатывается так же, как Ctrl+C
+    main_pid = os.getpid()
+    def stop(signum, frame):
+        if os.getpid() == main_pid:
+            raise KeyboardInterrupt
+    previous_handler = signal.signal(signal.SIGTERM, stop)
+
+    def finish(future):
+        # Возвращает True, если процесс пула погиб (например, его убила
+        # система из-за нехватки памяти) и пул нужно создать заново
+        path, seen, submitted = running.pop(future)
+        try:
+            result = future.result()
+        except Exception as e:
+            result = crashed_task_result(path, e, time.perf_counter() - submitted)
+        result['latency'] = time.perf_counter() - seen
+        finished.append(result)
+        if run_log:
+            try:
+                append_run_log(run_log, result, options)
+            except OSError as e:
+                print(f"Не удалось записать журнал {run_log}: {e}", file=sys.stderr)
+        try:
+            target = move_to(path, done_dir if result['error'] is None else failed_dir)
+        except OSError as e:
+            # Файл удалили или заблокировали, пока он был в работе
+            target = None
+            print(f"Не удалось перенести {path}: {e}", file=sys.stderr)
+        moved = f", файл перенесен в {target}" if target else ''
+        if result['error'] is None:
+            print(f"Готово: {path} -> {result['output']} ({result['rows']} строк, "
+                  f"обработка {result['seconds']:.2f} с, задержка {result['latency']:.2f} с){moved}")
+        else:
+            print(f"Ошибка: {path}: {result['error']}{moved}", file=sys.stderr)
+        return isinstance(future.exception(), BrokenProcessPool)
+
+    executor = ProcessPoolExecutor(max_workers=jobs, initializer=ignore_sigint)
+    try:
+        while True:
+            now = time.perf_counter()
+            snapshot = scan_inbox(inbox)
+            in_work = {path for path, _, _ in running.values()}
+            for path in set(pending) - set(snapshot):
+                del pending[path]
+            for path, signature in snapshot.items():
+                if path in in_work:
+                    continue
+                state = pending.get(path)
+                if state is None or state['signature'] != signature:
+                    # Новый или еще дописываемый файл: отсчет стабильности заново
+                    pending[path] = {'signature': signature, 'polls': 1, 'seen': state['seen'] if state else now}
+                else:
+                    state['polls'] += 1
+
+            ready = [path for path, state in pending.items()
+                     if state['polls'] >= WATCH_BROKEN_POLLS
+                     or state['polls'] >= WATCH_STABLE_POLLS and zipfile.is_zipfile(path)]
+            for path in sorted(ready, key=lambda path: pending[path]['seen']):
+                if len(running) >= jobs:
+                    break
+                try:
+                    future = executor.submit(process_file_task, (path, options))
+                except BrokenProcessPool:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    executor = ProcessPoolExecutor(max_workers=jobs, initializer=ignore_sigint)
+                    future = executor.submit(process_file_task, (path, options))
+                running[future] = (path, pending.pop(path)['seen'], time.perf_counter())
+                print(f"\nВ работе: {path}")
+
+            if not running:
+                time.sleep(poll_seconds)
+                continue
+            completed, _ = wait(running, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            broken = [finish(future) for future in completed]
+            if any(broken):
+                # Остальные файлы погибшего пула тоже завершатся с ошибкой и
+                # будут перенесены в failed на следующих итерациях
+                print("Процесс обработки завершился аварийно, пул процессов создан заново", file=sys.stderr)
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = ProcessPoolExecutor(max_workers=jobs, initializer=ignore_sigint)
+    except KeyboardInterrupt:
+        print(f"\nОстановка слежения, ожидание файлов в работе: {len(running)}...")
+        # Начатые файлы дорабатываются: процессы пула Ctrl+C игнорируют. Если
+        # ожидание прервать повторным Ctrl+C, файл остается во входящей папке
+        # до следующего запуска
+        for future in list(running):
+            path = running[future][0]
+            try:
+                finish(future)
+            except KeyboardInterrupt:
+                running.pop(future, None)
+                print(f"Обработка {path} прервана, файл оставлен во входящей папке", file=sys.stderr)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        signal.signal(signal.SIGTERM, previous_handler)
+    print_watch_summary(finished, time.perf_counter() - started)
+    return EXIT_FAILED if any(result['error'] is not None for result in finished) else EXIT_OK
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv:
+        run_interactive()
+        return EXIT_OK
+    return run_batch(argv)
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
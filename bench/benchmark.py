@@ -0,0 +1,174 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from generate_export import generate_export
+
+# Замеры скорости QMA по этапам на синтетических выгрузках. Результаты
+# сохраняются в JSON и сравниваются с сохраненной базовой линией
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_PATH = os.path.join(BENCH_DIR, os.pardir, 'QMA 4.1.py')
+DATA_DIR = os.path.join(BENCH_DIR, 'data')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+SITE_URL = 'https://site.ru'
+# Точные адреса, префиксы и маски — все виды строк urls.txt
+URL_PATTERNS = {'/catalog/1/', '/catalog/*', '/blog/1*', '/news/*/'}
+
+def load_script(path=SCRIPT_PATH):
+    # Имя скрипта содержит пробел и точку, поэтому обычный import не подходит
+    spec = importlib.util.spec_from_file_location('qma', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def export_path(rows, days, mode):
+    name = 'queries' if mode == 1 else 'pages'
+    return os.path.join(DATA_DIR, f'{name}-{rows}x{days}.xlsx')
+
+def ensure_export(rows, days, mode):
+    # Сгенерированные выгрузки переиспользуются между запусками
+    path = export_path(rows, days, mode)
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        print(f'Генерация {os.path.basename(path)}...')
+        generate_export(path, rows, days, mode)
+    return path
+
+def timed(function, *args):
+    with contextlib.redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        result = function(*args)
+        return result, time.perf_counter() - started
+
+def run_case(qma, path, mode, out_dir):
+    timings = {}
+    df, timings['load'] = timed(qma.load_data, path, mode, False)
+
+    if mode == 1:
+        def metrics(df):
+            tokens = qma.tokenize_queries(df['Query'])
+            return qma.process_queries_data(df, SITE_URL, tokens), tokens
+        (result_df, tokens), timings['metrics'] = timed(metrics, df.copy())
+        word_count_df, timings['words'] = timed(qma.create_word_count_df, result_df, tokens)
+        sheets = {'Семантическое ядро': result_df, 'Статистика слов': word_count_df}
+
+        def ngrams(result_df, tokens):
+            return {sheet_name: qma.create_ngram_df(result_df, tokens, n) for n, sheet_name in qma.NGRAM_SHEETS.items()}
+        ngram_sheets, timings['ngrams'] = timed(ngrams, result_df, tokens)
+        sheets.update(ngram_sheets)
+    else:
+        result_df, timings['metrics'] = timed(qma.process_pages_data, df.copy(), SITE_URL)
+        sheets = {'Страницы': result_df}
+
+    def cannibalization(result_df):
+        return qma.create_cannibalization_df(qma.cannibalization_pairs(result_df))
+    sheets['Каннибализация'], timings['cannibalization'] = timed(cannibalization, result_df)
+    _, timings['filter'] = timed(qma.filter_by_urls, result_df, URL_PATTERNS, SITE_URL)
+    for output_format in ('xlsx', 'csv'):
+        output_file_name = os.path.join(out_dir, f'result.{output_format}')
+        _, timings[f'write_{output_format}'] = timed(qma.write_report, output_file_name, sheets, output_format)
+    return timings
+
+def run_benchmarks(sizes, days, modes, repeat):
+    qma = load_script()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='qma-bench-') as out_dir:
+        for mode in modes:
+            for rows in sizes:
+                path = ensure_export(rows, days, mode)
+                case = os.path.splitext(os.path.basename(path))[0]
+                # Берется лучшее время из нескольких повторов: оно меньше всего зависит от фоновой нагрузки
+                runs = [run_case(qma, path, mode, out_dir) for _ in range(repeat)]
+                results[case] = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+                results[case]['total'] = sum(results[case][stage] for stage in runs[0])
+                print(f'{case}: ' + ', '.join(f'{stage} {seconds:.3f} с' for stage, seconds in results[case].items()))
+    return results
+
+def environment():
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def compare(results, baseline, threshold):
+    # Регрессия — этап, который стал медленнее базовой линии больше чем на threshold
+    regressions = []
+    print(f"\nСравнение с базовой линией от {baseline['environment']['date']}:")
+    for case, timings in results.items():
+        base = baseline['results'].get(case)
+        if base is None:
+            print(f'{case}: нет в базовой линии')
+            continue
+        for stage, seconds in timings.items():
+            if stage not in base:
+                continue
+            ratio = seconds / base[stage] if base[stage] else float('inf')
+            mark = ''
+            # Этапы короче 10 мс слишком шумные, чтобы считать их регрессией
+            if ratio > 1 + threshold and seconds - base[stage] > 0.01:
+                mark = '  <-- РЕГРЕССИЯ'
+                regressions.append((case, stage, ratio))
+            print(f'{case:<20} {stage:<11} {base[stage]:>9.3f} -> {seconds:>9.3f} с  x{ratio:.2f}{mark}')
+    return regressions
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Замеры скорости QMA по этапам на синтетических выгрузках')
+    parser.add_argument('--sizes', type=parse_sizes, default=[1000, 10000, 100000],
+                        help='размеры выгрузок через запятую (по умолчанию 1000,10000,100000)')
+    parser.add_argument('--days', type=int, default=14, help='число дней в выгрузке (по умолчанию 14)')
+    parser.add_argument('--mode', choices=['1', '2', 'both'], default='both',
+                        help='1 — отчет по запросам, 2 — по страницам, both — оба (по умолчанию)')
+    parser.add_argument('--repeat', type=int, default=3, help='число повторов каждого замера (по умолчанию 3)')
+    parser.add_argument('--output', help='файл JSON для результатов')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='файл базовой линии (по умолчанию bench/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='сохранить результаты как новую базовую линию')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='допустимое замедление относительно базовой линии (по умолчанию 0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    modes = [1, 2] if args.mode == 'both' else [int(args.mode)]
+    report = {'environment': environment(), 'results': run_benchmarks(args.sizes, args.days, modes, args.repeat)}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f'\nРезультаты сохранены в {args.output}')
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+        print(f'\nБазовая линия сохранена в {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'\nБазовая линия {args.baseline} не найдена, запустите с --save-baseline.')
+        return 0
+
+    with open(args.baseline, encoding='utf-8') as file:
+        baseline = json.load(file)
+    regressions = compare(report['results'], baseline, args.threshold)
+    if regressions:
+        print(f'\nЗамедлились этапов: {len(regressions)}')
+        return 1
+    print('\nРегрессий нет')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+import argparse
+import os
+from datetime import date, timedelta
+
+import numpy as np
+import openpyxl
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# Генератор синтетических выгрузок «Мониторинга запросов» Яндекс.Вебмастера
+# для замеров скорости. Раскладка колонок повторяет настоящие выгрузки:
+# отчет по запросам — Query, Url и колонки ГГГГ-ММ-ДД_demand/_shows/_position/_clicks,
+# отчет по страницам — Url перед Query и колонки _shows/_position/_clicks/_ctr
+
+WORDS = [
+    'купить', 'цена', 'москва', 'спб', 'недорого', 'отзывы', 'как', 'выбрать', 'для', 'в',
+    'ноутбук', 'телефон', 'смартфон', 'диван', 'кровать', 'шкаф', 'стол', 'стул', 'кресло', 'матрас',
+    'ремонт', 'доставка', 'интернет', 'магазин', 'каталог', 'акция', 'скидка', 'распродажа', 'новый', 'бу',
+    'игровой', 'детский', 'офисный', 'угловой', 'раскладной', 'белый', 'черный', 'серый', 'большой', 'маленький',
+    'samsung', 'apple', 'xiaomi', 'asus', 'lenovo', 'ikea', 'hoff', 'сделать', 'своими', 'руками',
+    'фото', 'размеры', 'характеристики', 'сравнение', 'рейтинг', '2024', 'лучший', 'дешево', 'оптом', 'рядом',
+]
+SECTIONS = ['catalog', 'blog', 'news', 'product', 'articles', 'services']
+MODE_METRICS = {
+    1: ('demand', 'shows', 'position', 'clicks'),
+    2: ('shows', 'position', 'clicks', 'ctr'),
+}
+
+def zipf_choice(rng, size, count):
+    # Частоты слов и посещаемость страниц распределены по закону Ципфа
+    weights = 1 / np.arange(1, count + 1)
+    return rng.choice(count, size=size, p=weights / weights.sum())
+
+def generate_rows(rng, rows, days, mode, pages):
+    lengths = rng.choice([1, 2, 3, 4, 5, 6], size=rows, p=[0.1, 0.3, 0.3, 0.17, 0.09, 0.04])
+    words = np.array(WORDS, dtype=object)[zipf_choice(rng, lengths.sum(), len(WORDS))]
+    ends = np.cumsum(lengths)
+    queries = [' '.join(words[end - length:end]) for end, length in zip(ends, lengths)]
+
+    page_ids = zipf_choice(rng, rows, pages)
+    urls = [f'/{SECTIONS[page % len(SECTIONS)]}/{page}/' for page in page_ids]
+
+    # Спрос — логнормальный по запросам, по дням — пуассоновский шум вокруг него
+    base = rng.lognormal(mean=2.5, sigma=1.5, size=(rows, 1))
+    demand = rng.poisson(np.broadcast_to(base, (rows, days)))
+    coverage = rng.beta(2, 3, size=(rows, 1))
+    shows = rng.binomial(demand, np.broadcast_to(coverage, (rows, days)))
+    level = rng.uniform(1, 40, size=(rows, 1))
+    position = np.where(shows > 0, np.round(np.clip(level + rng.normal(0, 3, size=(rows, days)), 1, 100), 1), 0)
+    click_rate = np.where(shows > 0, 0.3 / np.maximum(position, 1), 0)
+    clicks = rng.binomial(shows, click_rate)
+    ctr = np.where(shows > 0, np.round(clicks / np.maximum(shows, 1) * 100, 2), 0)
+
+    metrics = {'demand': demand, 'shows': shows, 'position': position, 'clicks': clicks, 'ctr': ctr}
+    values = np.concatenate([metrics[name].astype(object) for name in MODE_METRICS[mode]], axis=1)
+    keys = zip(queries, urls) if mode == 1 else zip(urls, queries)
+    for key, row in zip(keys, values.tolist()):
+        yield [*key, *row]
+
+def generate_export(file_path, rows, days=14, mode=1, seed=0, start=date(2024, 10, 1), batch_rows=10000):
+    rng = np.random.default_rng(seed)
+    dates = [(start + timedelta(days=day)).isoformat() for day in range(days)]
+    header = ['Query', 'Url'] if mode == 1 else ['Url', 'Query']
+    header += [f'{day}_{metric}' for metric in MODE_METRICS[mode] for day in dates]
+    pages = max(rows // 5, 1)
+
+    if xlsxwriter is not None:
+        workbook = xlsxwriter.Workbook(file_path, {'constant_memory': True, 'strings_to_numbers': False,
+                                                   'strings_to_formulas': False, 'strings_to_urls': False})
+        worksheet = workbook.add_worksheet('Sheet1')
+        worksheet.write_row(0, 0, header)
+        row_number = 1
+        for start_row in range(0, rows, batch_rows):
+            for row in generate_rows(rng, min(batch_rows, rows - start_row), days, mode, pages):
+                worksheet.write_row(row_number, 0, row)
+                row_number += 1
+        workbook.close()
+    else:
+        workbook = openpyxl.Workbook(write_only=True)
+        worksheet = workbook.create_sheet('Sheet1')
+        worksheet.append(header)
+        for start_row in range(0, rows, batch_rows):
+            for row in generate_rows(rng, min(batch_rows, rows - start_row), days, mode, pages):
+                worksheet.append(row)
+        workbook.save(file_path)
+    return file_path
+
+def main():
+    parser = argparse.ArgumentParser(description='Генератор синтетических выгрузок Яндекс.Вебмастера для замеров')
+    parser.add_argument('output', help='имя создаваемого .xlsx файла')
+    parser.add_argument('--rows', type=int, default=10000, help='число строк (по умолчанию 10000)')
+    parser.add_argument('--days', type=int, default=14, help='число дней в выгрузке (по умолчанию 14)')
+    parser.add_argument('--mode', type=int, choices=[1, 2], default=1,
+                        help='1 — отчет по запросам, 2 — отчет по страницам')
+    parser.add_argument('--seed', type=int, default=0, help='зерно генератора случайных чисел')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    generate_export(args.output, args.rows, args.days, args.mode, args.seed)
+    print(f'Создан файл {args.output}: {args.rows} строк, {args.days} дней')
+
+if __name__ == '__main__':
+    main()
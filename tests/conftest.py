@@ -0,0 +1,42 @@
+import importlib.util
+import os
+
+import openpyxl
+import pytest
+
+SITE_URL = 'https://site.ru'
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'QMA 4.1.py')
+GENERATOR_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bench', 'generate_export.py')
+
+def load_module(name, path):
+    # Имя скрипта содержит пробел и точку, поэтому обычный import не подходит
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture(scope='session')
+def qma():
+    return load_module('qma', SCRIPT_PATH)
+
+@pytest.fixture(scope='session')
+def generate_export():
+    # Генератор синтетических выгрузок из bench/
+    return load_module('generate_export', GENERATOR_PATH).generate_export
+
+def write_export(path, queries, urls=None, positions=None):
+    # Частотность растет с номером строки, так что последний запрос — самый частотный
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(['Query', 'Url', '2024-01-01_demand', '2024-01-01_shows', '2024-01-01_position', '2024-01-01_clicks'])
+    for i, query in enumerate(queries):
+        url = urls[i] if urls else f'/page/{i}/'
+        position = positions[i] if positions else 3.1 + i
+        sheet.append([query, url, 10 + i, 5 + i, position, i])
+    workbook.save(path)
+
+def build_sheets(qma, tmp_path, queries, urls=None, positions=None, **options):
+    # Листы отчета по запросам для выгрузки из write_export
+    export = str(tmp_path / 'export.xlsx')
+    write_export(export, queries, urls, positions)
+    return qma.build_report(qma.load_data(export, use_cache=False), 1, SITE_URL, **options)
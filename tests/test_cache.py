@@ -0,0 +1,43 @@
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import write_export
+
+@pytest.fixture
+def cache_dir(qma, tmp_path, monkeypatch):
+    monkeypatch.setattr(qma, 'CACHE_DIR', str(tmp_path / '.qma_cache'))
+    return tmp_path / '.qma_cache'
+
+@pytest.mark.parametrize('queries', [
+    ['купить диван', 'диван цена', 'диван'],
+    # Числовой запрос среди строк Arrow не сохраняет, кэш пишется в npy
+    ['купить диван', 2024, 'диван'],
+])
+def test_second_load_hits_cache(qma, tmp_path, cache_dir, queries):
+    export = str(tmp_path / 'export.xlsx')
+    write_export(export, queries)
+
+    first = qma.load_data(export, use_cache=True)
+    entries = os.listdir(cache_dir)
+    assert len(entries) == 1 and '.tmp' not in entries[0]
+
+    second = qma.load_data(export, use_cache=True)
+    pd.testing.assert_frame_equal(plain(first), plain(second))
+
+def test_unreadable_entry_is_a_miss(qma, tmp_path, cache_dir):
+    export = str(tmp_path / 'export.xlsx')
+    write_export(export, ['купить диван', 'диван'])
+    first = qma.load_data(export, use_cache=True)
+
+    entry = cache_dir / os.listdir(cache_dir)[0]
+    for name in os.listdir(entry):
+        if name != 'meta.json':
+            (entry / name).write_bytes(b'broken')
+
+    second = qma.load_data(export, use_cache=True)
+    pd.testing.assert_frame_equal(plain(first), plain(second))
+
+def plain(df):
+    return df.astype({name: object for name in df.columns if isinstance(df[name].dtype, pd.CategoricalDtype)})
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+SITE_URL = 'https://site.ru'
+
+@pytest.fixture(scope='module', params=[1, 2], ids=['queries', 'pages'])
+def export(request, tmp_path_factory, generate_export):
+    path = str(tmp_path_factory.mktemp('export') / f'export-{request.param}.xlsx')
+    return generate_export(path, 500, mode=request.param, seed=request.param)
+
+@pytest.fixture(autouse=True)
+def small_blocks(qma, monkeypatch):
+    # Куски режутся по границам блоков строк листа, а вся выгрузка поместилась
+    # бы в один блок
+    monkeypatch.setattr(qma.iter_xlsx_row_blocks, '__defaults__', (4096,))
+
+def run(qma, export, out_dir, **options):
+    out_dir.mkdir()
+    result = qma.process_file(export, SITE_URL, out_dir=str(out_dir), use_cache=False, output_format='csv', **options)
+    assert result['output']
+    return {name: (out_dir / name).read_bytes() for name in sorted(os.listdir(out_dir))}
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'urls_set': {'/catalog/*', '/blog/*'}},
+    # Фильтр, которому не подходит ни один URL, отключается
+    {'urls_set': {'/nothing/'}},
+    {'top': 20},
+    {'urls_set': {'/news/*'}, 'top': 20},
+], ids=['all', 'urls', 'no-match', 'top', 'urls-top'])
+def test_chunked_output_matches_in_memory(qma, tmp_path, export, options):
+    # Куски меньше любой группы одинаковых URL и запросов, так что слияние
+    # прогонов, сводки и каннибализация собираются из многих кусков
+    in_memory = run(qma, export, tmp_path / 'in-memory', **options)
+    timings = []
+    chunked = run(qma, export, tmp_path / 'chunked', chunk_rows=70, timings=timings, **options)
+    assert sum(timing['stage'] == 'metrics' for timing in timings) > 3
+    assert chunked.keys() == in_memory.keys()
+    for name in in_memory:
+        assert chunked[name] == in_memory[name], name
+
+def test_ngram_counts_stay_bounded(qma):
+    # Lossy counting: Количество занижено не больше чем на rows_seen / bucket_rows,
+    # все частые ключи на месте, а таблица намного меньше числа различных ключей
+    rng = np.random.default_rng(0)
+    keys = (rng.zipf(1.3, size=20000) % 5000).astype(np.int64)
+    bucket_rows, chunk_size = 200, 50
+    total = None
+    for start in range(0, len(keys), chunk_size):
+        counts = pd.Series(keys[start:start + chunk_size]).value_counts()
+        total = qma.merge_ngram_counts(total, pd.DataFrame({'Количество': counts}), start, start + chunk_size,
+                                       bucket_rows)
+
+    exact = pd.Series(keys).value_counts()
+    error = len(keys) // bucket_rows
+    counted = total['Количество']
+    assert (counted <= exact[counted.index]).all()
+    assert (counted >= exact[counted.index] - error).all()
+    assert set(exact[exact > error].index) <= set(counted.index)
+    assert len(total) < len(exact) / 4
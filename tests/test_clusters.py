@@ -0,0 +1,27 @@
+import pytest
+
+from conftest import build_sheets as build
+
+@pytest.mark.parametrize('queries', [
+    # LSH не находит ни одной пары кандидатов
+    ['купить диван', 'телефон samsung', 'стол'],
+    ['стол'],
+])
+def test_clusters_without_candidate_pairs(qma, tmp_path, queries):
+    sheets = build(qma, tmp_path, queries, cluster_threshold=qma.CLUSTER_THRESHOLD)
+    assert sorted(sheets['Семантическое ядро']['Кластер']) == list(range(1, len(queries) + 1))
+    assert len(sheets['Кластеры']) == len(queries)
+
+def test_similar_queries_share_a_cluster(qma, tmp_path):
+    sheets = build(qma, tmp_path, ['купить диван', 'диван купить', 'купить диван недорого', 'стол'],
+                   cluster_threshold=qma.CLUSTER_THRESHOLD,
+                   urls=['/divan/', '/divan/', '/divan/', '/stol/'], positions=[0, 4, 0, 5])
+    clusters = sheets['Семантическое ядро'].set_index('Query')
+    assert clusters.loc[['купить диван', 'диван купить'], 'Название кластера'].tolist() == ['купить диван недорого'] * 2
+    assert clusters.loc['стол', 'Кластер'] == 2
+
+    summary = sheets['Кластеры'].set_index('Кластер')
+    assert summary.loc[1, 'Запросов'] == 3
+    assert summary.loc[1, 'Основной URL'] == '/divan/'
+    # Запросы без позиции в среднюю позицию не входят
+    assert summary.loc[1, 'Ср. позиция'] == 4.0
@@ -0,0 +1,21 @@
+from conftest import build_sheets
+
+def test_word_order_and_typos_are_duplicates(qma, tmp_path):
+    queries = ['купить диван', 'диван купить', 'купить дивна', 'стол', 'купить стол', 'стол купить']
+    sheets = build_sheets(qma, tmp_path, queries, positions=[0, 4, 6, 5, 0, 0], dedup=True)
+    variants = dict(zip(sheets['Семантическое ядро']['Query'], sheets['Семантическое ядро']['Основной вариант']))
+    # Основной вариант — самый частотный запрос группы; у «стол» дублей нет
+    assert variants == {'купить диван': 'купить дивна', 'диван купить': 'купить дивна', 'купить дивна': 'купить дивна',
+                        'стол': '', 'купить стол': 'стол купить', 'стол купить': 'стол купить'}
+
+    duplicates = sheets['Дубли'].set_index('Основной вариант')
+    assert duplicates.loc['купить дивна', 'Запросов'] == 3
+    assert duplicates.loc['купить дивна', 'Варианты'] == 'диван купить, купить диван'
+    # Запросы без позиции в среднюю позицию не входят, а группа без позиций получает 0
+    assert duplicates.loc['купить дивна', 'Ср. позиция'] == 5.0
+    assert duplicates.loc['стол купить', 'Ср. позиция'] == 0
+
+def test_queries_without_words_are_not_duplicates(qma, tmp_path):
+    sheets = build_sheets(qma, tmp_path, ['!!!', '???', 'диван'], dedup=True)
+    assert (sheets['Семантическое ядро']['Основной вариант'] == '').all()
+    assert sheets['Дубли'].empty
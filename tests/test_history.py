@@ -0,0 +1,38 @@
+import sqlite3
+from contextlib import closing
+
+import openpyxl
+
+SITE_URL = 'https://site.ru'
+
+def write_export(path, days, shows):
+    # Отчет по запросам с колонкой CTR, которая самому отчету не нужна
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(['Query', 'Url'] + [f'{day}_{metric}' for metric in ('demand', 'shows', 'position', 'clicks', 'ctr')
+                                     for day in days])
+    for i, query in enumerate(['купить диван', 'диван']):
+        sheet.append([query, f'/page/{i}/'] + [10] * len(days) + [shows + i] * len(days) + [3.5] * len(days)
+                     + [1] * len(days) + [12.5] * len(days))
+    workbook.save(path)
+
+def test_history_keeps_every_metric_and_updates_days(qma, tmp_path):
+    db = str(tmp_path / 'history.db')
+    first, second = str(tmp_path / 'first.xlsx'), str(tmp_path / 'second.xlsx')
+    write_export(first, ['2024-10-01', '2024-10-02'], shows=5)
+    write_export(second, ['2024-10-02', '2024-10-03'], shows=7)
+    for export in (first, second):
+        qma.process_file(export, SITE_URL, out_dir=str(tmp_path), use_cache=False, output_format='csv',
+                         history_db=db, chunk_rows=1 if export == second else None)
+
+    history = qma.read_history(db, 'site.ru')
+    assert sorted(history['metric'].unique()) == ['clicks', 'ctr', 'demand', 'position', 'shows']
+    # Пересекающийся день не дублируется, а получает значение из второй выгрузки
+    assert len(history) == 2 * 3 * 5
+    shows = history[(history['metric'] == 'shows') & (history['Query'] == 'диван')].set_index('date')['value']
+    assert shows.to_dict() == {'2024-10-01': 6, '2024-10-02': 8, '2024-10-03': 8}
+    with closing(sqlite3.connect(db)) as connection:
+        assert connection.execute('SELECT COUNT(*) FROM history_keys').fetchone() == (2,)
+
+    ctr = qma.read_history(db, 'site.ru', date_from='2024-10-02', date_to='2024-10-02', metrics=['ctr'])
+    assert ctr['value'].tolist() == [12.5, 12.5]
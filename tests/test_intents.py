@@ -0,0 +1,23 @@
+import pandas as pd
+import pytest
+
+def classify(qma, queries, dictionaries=None):
+    df = pd.DataFrame({'Query': queries})
+    df = qma.add_intent_columns(df, qma.tokenize_queries(df['Query']), dictionaries)
+    return list(df['Бренд']), list(df['Интент'])
+
+@pytest.mark.parametrize('query, intent', [
+    ('цены на диван', 'Коммерческий'),
+    ('диван рядом', 'Геозависимый'),
+    ('как сделать своими руками', 'Информационный'),
+    # Основы слов словаря («рядом» → «ряд», «цене» → «цен») не ищутся
+    ('ряды в кинотеатре', 'Неизвестно'),
+    ('ценный груз', 'Неизвестно'),
+])
+def test_default_dictionaries_match_exact_forms(qma, query, intent):
+    assert classify(qma, [query])[1] == [intent]
+
+def test_star_entries_match_all_forms(qma):
+    dictionaries = dict(qma.DEFAULT_DICTIONARIES, brand=['Яндекс*', 'happy*', 'ya'])
+    brands, _ = classify(qma, ['яндекса карты', 'Happy day', 'ya ru', 'yandex'], dictionaries)
+    assert brands == ['Да', 'Да', 'Да', 'Нет']
@@ -0,0 +1,107 @@
+import re
+import zipfile
+
+import numpy as np
+import openpyxl
+import pandas as pd
+import pytest
+import xlsxwriter
+
+# 14 дней по 4 метрики, как в настоящей выгрузке: колонки доходят до BF
+HEADER = ['Query', 'Url'] + [f'2024-01-{day:02d}_{metric}' for day in range(1, 15)
+                             for metric in ('demand', 'shows', 'position', 'clicks')]
+NUM_VALUES = len(HEADER) - 2
+
+def export_rows(num_rows=300, seed=0):
+    # Строки с обычными числами вперемешку с тем, что быстрый разбор должен
+    # отдать медленному: числа в текстовых колонках, логические значения,
+    # экранирование, пустые ячейки и экспоненциальная запись
+    rng = np.random.default_rng(seed)
+    special_queries = [2024, True, '"кавычки" & <теги>', '  пробелы  ', 'ё&amp;', None, 3.5]
+    special_values = [None, 1.5e-7, 2.5e20, 0, -1, 12.25, 1 / 3]
+    rows = []
+    for i in range(num_rows):
+        query = special_queries[i % len(special_queries)] if i % 5 == 0 else f'запрос {i}'
+        url = None if i % 11 == 0 else f'/page/{i % 17}/?a=1&b=<{i}>'
+        values = [int(value) for value in rng.integers(0, 1000, size=NUM_VALUES)]
+        values[2::4] = [round(float(value), 2) for value in rng.uniform(1, 50, size=NUM_VALUES // 4)]
+        if i % 3 == 0:
+            values[i % NUM_VALUES] = special_values[i % len(special_values)]
+        rows.append([query, url, *values])
+    rows.append([None] * len(HEADER))
+    rows.append(['последний', '/last/', *range(NUM_VALUES)])
+    return rows
+
+def write_openpyxl(path, rows):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(HEADER)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+def write_xlsxwriter(path, rows, **options):
+    workbook = xlsxwriter.Workbook(path, options)
+    sheet = workbook.add_worksheet()
+    for i, row in enumerate([HEADER, *rows]):
+        for j, value in enumerate(row):
+            if value is not None:
+                sheet.write(i, j, value)
+    workbook.close()
+
+WRITERS = {
+    'openpyxl': write_openpyxl,
+    'xlsxwriter': write_xlsxwriter,
+    'constant_memory': lambda path, rows: write_xlsxwriter(path, rows, constant_memory=True),
+}
+
+def assert_matches_read_excel(df, path):
+    # Полностью пустые строки быстрый разбор отбрасывает; пропуск в текстовой
+    # колонке — None, а у pd.read_excel — NaN
+    expected = pd.read_excel(path).dropna(how='all').reset_index(drop=True)[list(df.columns)]
+    pd.testing.assert_frame_equal(plain(df), plain(expected), check_dtype=False)
+
+def plain(df):
+    df = df.astype({name: object for name in df.columns if isinstance(df[name].dtype, pd.CategoricalDtype)})
+    return df.astype(object).where(df.notna(), np.nan)
+
+@pytest.fixture(params=[None, 256], ids=['one-block', 'small-blocks'])
+def block_size(request, qma, monkeypatch):
+    # Маленькие блоки проверяют строки и ячейки на границах блоков
+    if request.param:
+        monkeypatch.setattr(qma.iter_xlsx_row_blocks, '__defaults__', (request.param,))
+    return request.param
+
+@pytest.mark.parametrize('writer', WRITERS)
+def test_read_xlsx_columns_matches_read_excel(qma, tmp_path, block_size, writer):
+    path = str(tmp_path / 'export.xlsx')
+    WRITERS[writer](path, export_rows())
+    assert_matches_read_excel(qma.read_xlsx_columns(path), path)
+
+@pytest.mark.parametrize('writer', WRITERS)
+def test_iter_xlsx_chunks_matches_read_excel(qma, tmp_path, block_size, writer):
+    path = str(tmp_path / 'export.xlsx')
+    WRITERS[writer](path, export_rows())
+    chunks = list(qma.iter_xlsx_chunks(path, chunk_rows=50))
+    # Куски режутся по границам блоков строк
+    assert len(chunks) > 1 or not block_size
+    assert_matches_read_excel(pd.concat([plain(chunk) for chunk in chunks]), path)
+
+def test_unknown_cell_attributes_use_element_tree(qma, tmp_path, monkeypatch):
+    # Ячейки с атрибутами, которых не ждут ни векторный разбор, ни регулярное
+    # выражение (здесь ph), разбираются через ElementTree
+    source, path = str(tmp_path / 'source.xlsx'), str(tmp_path / 'export.xlsx')
+    write_openpyxl(source, export_rows(60))
+    with zipfile.ZipFile(source) as archive, zipfile.ZipFile(path, 'w') as target:
+        for item in archive.infolist():
+            data = archive.read(item)
+            if item.filename == 'xl/worksheets/sheet1.xml':
+                data = re.sub(rb'(<c r="[A-Z]+\d+")', rb'\1 ph="1"', data)
+            target.writestr(item, data)
+
+    calls = []
+    fromstring = qma.fromstring
+    monkeypatch.setattr(qma, 'fromstring', lambda block: calls.append(block) or fromstring(block))
+    df = qma.read_xlsx_columns(path)
+    assert calls
+    assert_matches_read_excel(df, source)
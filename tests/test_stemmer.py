@@ -0,0 +1,44 @@
+import sys
+
+import pandas as pd
+import pytest
+
+from conftest import SCRIPT_PATH, load_module
+
+# Основы по алгоритму Snowball для русского языка
+RUSSIAN_STEMS = {
+    'купить': 'куп', 'купите': 'куп', 'купил': 'куп', 'диваны': 'дива', 'москве': 'москв', 'москвы': 'москв',
+    'красивая': 'красив', 'красивейший': 'красив', 'рядом': 'ряд', 'цене': 'цен', 'ценный': 'цен',
+    'кинотеатре': 'кинотеатр', 'бегущий': 'бегущ', 'бегая': 'бег', 'отзывы': 'отзыв', 'инструкция': 'инструкц',
+    'своими': 'сво', 'руками': 'рук', 'стоимость': 'стоимост', 'недорого': 'недор', 'доставкой': 'доставк',
+    'магазинах': 'магазин', 'шкафов': 'шкаф', 'кухни': 'кухн', 'смотреть': 'смотрет', 'бесплатно': 'бесплатн',
+    'в': 'в', 'под': 'под', 'интернет': 'интернет',
+}
+
+@pytest.fixture(scope='module')
+def builtin_stemmer():
+    # Скрипт загружается без snowballstemmer, чтобы проверить встроенную реализацию
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setitem(sys.modules, 'snowballstemmer', None)
+        module = load_module('qma_builtin_stemmer', SCRIPT_PATH)
+    assert module.snowballstemmer is None
+    return module.stem_russian
+
+@pytest.mark.parametrize('word, stem', RUSSIAN_STEMS.items())
+def test_builtin_russian_stemmer_matches_snowball(builtin_stemmer, word, stem):
+    assert builtin_stemmer(word) == stem
+
+def test_builtin_russian_stemmer_matches_library(builtin_stemmer):
+    snowballstemmer = pytest.importorskip('snowballstemmer')
+    stem = snowballstemmer.stemmer('russian').stemWord
+    words = [word for word in RUSSIAN_STEMS] + ['яндекса', 'телефонами', 'ремонтируйте', 'лучшие', 'самые', 'всех']
+    assert [builtin_stemmer(word) for word in words] == [stem(word) for word in words]
+
+def test_word_forms_are_merged(qma):
+    counts = pd.DataFrame({'Слово': ['Купить,', 'купите', 'купил', 'Диван', 'дивана', '—'],
+                           'Количество': [5, 2, 1, 3, 4, 7]})
+    result = qma.normalize_word_counts(counts).set_index('Слово')
+    assert result.to_dict('index') == {
+        'купить': {'Количество': 8, 'Формы': 'купить, купите, купил'},
+        'дивана': {'Количество': 7, 'Формы': 'дивана, диван'},
+    }